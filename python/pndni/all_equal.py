@@ -1,17 +1,26 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from functools import partial
 import nibabel
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.openers import ImageOpener
 import numpy as np
+import os
+from pathlib import Path
 import sys
+from .utils import CHUNK_SIZE
 
 
 class _Result(object):
 
-    def __init__(self, desc=None, extra=None):
+    def __init__(self, desc=None, extra=None, diagnostics=None):
         if desc is None:
             self.desc = ''
         else:
             self.desc = desc
         self.extra = extra
+        self.diagnostics = diagnostics
         self.name = type(self).__name__  # https://www.w3resource.com/python-exercises/class-exercises/python-class-exercise-12.php
 
     def __repr__(self):
@@ -46,9 +55,19 @@ class AffineMismatch(_ErrorResult):
     status_code = 2
 
 
+class Missing(_ErrorResult):
+    status_code = 3
+
+
+class Failed(_ErrorResult):
+    status_code = 4
+
+
 ORIENTATION = [[0, 1],
                [1, 1],
                [2, 1]]
+# number of bytes read at once when comparing raw data
+BLOCK_SIZE = 2 ** 20
 
 
 def alleq(x, y):
@@ -59,10 +78,26 @@ def alleq_round(x, y):
     return np.all(np.around(x) == np.around(y))
 
 
-def norm(x):
+def eq_round(x, y):
+    return np.around(x) == np.around(y)
+
+
+# elementwise version of each comparison function
+ELEMENTWISE = {alleq: np.equal,
+               alleq_round: eq_round,
+               np.allclose: np.isclose}
+
+
+def norm(x, xmin=None, xmax=None):
+    """Remap x to the range 0-1. xmin and xmax default to the minimum and maximum of x, and
+    may be given when x is part of a larger image."""
     if x.dtype.kind != 'f':
         raise ValueError('norm may only be called on floating point types')
-    return (x - x.min()) / (x.max() - x.min())
+    if xmin is None:
+        xmin = x.min()
+    if xmax is None:
+        xmax = x.max()
+    return (x - xmin) / (xmax - xmin)
 
 
 def norm_comp(func):
@@ -71,6 +106,221 @@ def norm_comp(func):
     return _norm_alleq
 
 
+def _same_bytes(f1, f2, nbytes=None, blocksize=BLOCK_SIZE):
+    """Compare two open files block by block, up to nbytes bytes or the end of the files"""
+    remaining = nbytes
+    while remaining is None or remaining > 0:
+        n = blocksize if remaining is None else min(blocksize, remaining)
+        b1 = f1.read(n)
+        if b1 != f2.read(n):
+            return False
+        if len(b1) < n:
+            # end of file
+            return remaining is None
+        if remaining is not None:
+            remaining -= n
+    return True
+
+
+def raw_equal(im1, im2):
+    """Check whether the stored data of two images are identical without decoding them.
+    Returns True if both images are backed by :py:class:`nibabel.arrayproxy.ArrayProxy` objects
+    with the same shape, on-disk dtype, and scaling, and either the files or the raw data
+    blocks are byte-for-byte identical. Returns False otherwise (which does not mean the data differ).
+    """
+    p1 = im1.dataobj
+    p2 = im2.dataobj
+    if not (isinstance(p1, ArrayProxy) and isinstance(p2, ArrayProxy)):
+        return False
+    if p1.shape != p2.shape or p1.dtype != p2.dtype or p1.order != p2.order:
+        return False
+    if not (p1.slope == p2.slope and p1.inter == p2.inter):
+        return False
+    if isinstance(p1.file_like, str) and isinstance(p2.file_like, str):
+        if os.path.getsize(p1.file_like) == os.path.getsize(p2.file_like):
+            # identical files (including compressed files) need no decompression
+            with open(p1.file_like, 'rb') as f1, open(p2.file_like, 'rb') as f2:
+                if _same_bytes(f1, f2):
+                    return True
+    with ImageOpener(p1.file_like) as f1, ImageOpener(p2.file_like) as f2:
+        f1.seek(p1.offset)
+        f2.seek(p2.offset)
+        return _same_bytes(f1, f2, nbytes=int(np.prod(p1.shape)) * p1.dtype.itemsize)
+
+
+def _outside(shape, box):
+    """Split the part of an array of shape "shape" outside of box into non-overlapping boxes"""
+    inner = [(0, n) for n in shape]
+    regions = []
+    for axes, (start, stop) in enumerate(box):
+        for region_range in [(0, start), (stop, shape[axes])]:
+            if region_range[1] > region_range[0]:
+                region = list(inner)
+                region[axes] = region_range
+                regions.append(region)
+        inner[axes] = (start, stop)
+    return regions
+
+
+class _RASView(object):
+    """Read boxes of an image's data in RAS voxel order through its array proxy,
+    without loading or reorienting the whole image. Boxes are lists of (start, stop)
+    tuples for the three spatial axes, in RAS voxel coordinates. Any non-spatial
+    dimensions are always read in full. Images with fewer than three dimensions are
+    treated as having extra spatial axes of length one."""
+
+    def __init__(self, img, reorient=True):
+        self.dataobj = img.dataobj
+        self.inndim = len(img.shape)
+        self.inshape = tuple(img.shape) + (1,) * (3 - self.inndim)
+        if reorient:
+            self.ornt = nibabel.orientations.ornt_transform(nibabel.orientations.io_orientation(img.affine),
+                                                            ORIENTATION)
+        else:
+            self.ornt = np.array(ORIENTATION)
+        self.affine = img.affine.dot(nibabel.orientations.inv_ornt_aff(self.ornt, self.inshape))
+        # input axis for each RAS axis
+        self.order = [int(i) for i in np.argsort(self.ornt[:, 0])]
+        self.shape = tuple(self.inshape[i] for i in self.order) + tuple(self.inshape[3:])
+        # slabs are taken along the last spatial axis on disk
+        self.slab_axis = int(self.ornt[2, 0])
+        self.slab_reversed = bool(self.ornt[2, 1] == -1)
+
+    def read(self, box):
+        inslices = [None, None, None]
+        flips = []
+        for axes, (start, stop) in enumerate(box):
+            inaxes = self.order[axes]
+            if self.ornt[inaxes, 1] == -1:
+                n = self.inshape[inaxes]
+                inslices[inaxes] = slice(n - stop, n - start)
+                flips.append(inaxes)
+            else:
+                inslices[inaxes] = slice(start, stop)
+        data = np.asarray(self.dataobj[tuple(inslices[:self.inndim])])
+        if self.inndim < 3:
+            data = data.reshape(data.shape + (1,) * (3 - self.inndim))
+        if flips:
+            data = np.flip(data, axis=tuple(flips))
+        return data.transpose(self.order + list(range(3, data.ndim)))
+
+    def input_index(self, coords):
+        """Convert an (N, 3) array of RAS voxel coordinates to voxel indices of the original image"""
+        out = np.empty_like(coords)
+        for axes in range(3):
+            inaxes = self.order[axes]
+            if self.ornt[inaxes, 1] == -1:
+                out[:, inaxes] = self.inshape[inaxes] - 1 - coords[:, axes]
+            else:
+                out[:, inaxes] = coords[:, axes]
+        return out
+
+    def slabs(self, box, chunk_size, axis=None, reverse=None):
+        """Split box into slabs of at most chunk_size voxels (but at least one slice)"""
+        if axis is None:
+            axis = self.slab_axis
+        if reverse is None:
+            reverse = self.slab_reversed
+        slice_size = int(np.prod([stop - start for i, (start, stop) in enumerate(box) if i != axis]))
+        slice_size *= int(np.prod(self.shape[3:]))
+        step = max(1, chunk_size // max(1, slice_size))
+        start, stop = box[axis]
+        starts = range(start, stop, step)
+        if reverse:
+            starts = reversed(starts)
+        for slab_start in starts:
+            slab = list(box)
+            slab[axis] = (slab_start, min(slab_start + step, stop))
+            yield slab
+
+    def chunks(self, box, chunk_size, axis=None, reverse=None):
+        """Yield the data in box in slabs (see :py:meth:`slabs`)"""
+        for slab in self.slabs(box, chunk_size, axis=axis, reverse=reverse):
+            yield self.read(slab)
+
+    def range(self, box, chunk_size):
+        """Minimum and maximum of the data in box. Raises a ValueError for non floating point data"""
+        xmin = np.inf
+        xmax = -np.inf
+        for chunk in self.chunks(box, chunk_size):
+            if chunk.dtype.kind != 'f':
+                raise ValueError('norm may only be called on floating point types')
+            if chunk.size:
+                xmin = min(xmin, chunk.min())
+                xmax = max(xmax, chunk.max())
+        return xmin, xmax
+
+    def cropped_affine(self, box):
+        shift = np.eye(4)
+        shift[:3, -1] = [start for start, stop in box]
+        return self.affine.dot(shift)
+
+
+class Mismatches(object):
+    """Summary of the differences found by :py:func:`compare` with diagnostics=True:
+    the number of differing voxels, the maximum absolute and relative differences of the
+    differing values, the bounding box of the differing voxels (inclusive voxel indices of the
+    first image), and the first max_coords differing values as (index, value1, value2) tuples.
+    """
+
+    def __init__(self, max_coords=0):
+        self.count = 0
+        self.max_abs = 0.0
+        self.max_rel = 0.0
+        self.bbox_min = None
+        self.bbox_max = None
+        self.max_coords = max_coords
+        self.coords = []
+
+    def update(self, view, slab, x, y, neq):
+        """Add the differences in one slab. view is the _RASView of the first image,
+        x and y the data of the slab, and neq the elementwise result of the comparison"""
+        if not neq.any():
+            return
+        offset = [start for start, stop in slab]
+        spatial = neq.reshape(neq.shape[:3] + (-1,)).any(axis=-1)
+        index = view.input_index(np.transpose(np.nonzero(spatial)) + offset)
+        self.count += len(index)
+        if self.bbox_min is None:
+            self.bbox_min = index.min(axis=0)
+            self.bbox_max = index.max(axis=0)
+        else:
+            self.bbox_min = np.minimum(self.bbox_min, index.min(axis=0))
+            self.bbox_max = np.maximum(self.bbox_max, index.max(axis=0))
+        xd = x[neq].astype(np.double)
+        yd = y[neq].astype(np.double)
+        absdiff = np.abs(xd - yd)
+        denom = np.maximum(np.abs(xd), np.abs(yd))
+        # fmax ignores NaN
+        self.max_abs = float(np.fmax.reduce(absdiff, initial=self.max_abs))
+        self.max_rel = float(np.fmax.reduce(absdiff[denom > 0] / denom[denom > 0], initial=self.max_rel))
+        nmore = self.max_coords - len(self.coords)
+        if nmore > 0:
+            full = np.transpose(np.nonzero(neq))[:nmore]
+            spatial_index = view.input_index(full[:, :3] + offset)
+            for si, fi in zip(spatial_index, full):
+                self.coords.append((tuple(int(i) for i in si) + tuple(int(i) for i in fi[3:]),
+                                    x[tuple(fi)], y[tuple(fi)]))
+
+    def bbox(self):
+        if self.bbox_min is None:
+            return None
+        return [(int(lo), int(hi)) for lo, hi in zip(self.bbox_min, self.bbox_max)]
+
+    def write_coords(self, f):
+        """Write the differing values to an open file as TSV"""
+        ndim = max((len(index) for index, v1, v2 in self.coords), default=3)
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['i', 'j', 'k'] + [f'dim{i}' for i in range(4, ndim + 1)] + ['value1', 'value2'])
+        for index, v1, v2 in self.coords:
+            writer.writerow(list(index) + [v1, v2])
+
+    def __str__(self):
+        return (f'{self.count} voxels differ. Maximum absolute difference {self.max_abs}, '
+                f'maximum relative difference {self.max_rel}, bounding box {self.bbox()} '
+                f'(voxel indices of image1).')
+
+
 def orient(x):
     orn = nibabel.orientations.io_orientation(x.affine)
     difforn = nibabel.orientations.ornt_transform(orn, ORIENTATION)
@@ -85,8 +335,11 @@ def get_parser():
                                                  'with different data layouts, or where one is a cropped '
                                                  'version of the other (so long as the image orientations '
                                                  'in world coordinates are consistent).')
-    parser.add_argument('image1', help='Filename of first image to be compared')
-    parser.add_argument('image2', help='Filename of first image to be compared')
+    parser.add_argument('image1', nargs='?',
+                        help='Filename of first image to be compared. If image1 and image2 are both directories, '
+                             'compare all images matching --pattern, pairing them by their path relative to '
+                             'image1 and image2.')
+    parser.add_argument('image2', nargs='?', help='Filename of second image to be compared')
     mogroup = parser.add_mutually_exclusive_group()
     mogroup.add_argument('--close', action='store_true',
                          help='Use numpy.allclose instead of checking for strict equality.')
@@ -101,23 +354,169 @@ def get_parser():
     parser.add_argument('--normalize', action='store_true',
                         help='Remap images to the range 0-1 before comparing. '
                              'Only valid for floating point images (otherwise raises error).')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE,
+                        help='Maximum number of voxels read from each image at once. The images are '
+                             'compared slab by slab, so this limits memory use.')
+    parser.add_argument('--byte_check', action='store_true',
+                        help='If the images have the same shape and affine, first compare the raw data '
+                             '(and scaling) on disk, and report them as equal without decoding if they '
+                             'are identical. Falls back to the usual comparison otherwise. Note that '
+                             'identical NaN values are then considered equal. Ignored with --normalize.')
+    parser.add_argument('--diagnostics', action='store_true',
+                        help='If the images differ where they overlap, report the number of differing voxels, '
+                             'the maximum absolute and relative differences, and the bounding box of the '
+                             'differences (in voxel indices of image1). Implies --verbose when comparing '
+                             'two images. When comparing many images, these are added to the report.')
+    parser.add_argument('--diff_coords', type=Path,
+                        help='With --diagnostics, write the voxel indices (of image1) and values of the '
+                             'first --max_coords differing values to this TSV file.')
+    parser.add_argument('--max_coords', type=int, default=100,
+                        help='Maximum number of differing values written to --diff_coords')
     parser.add_argument('--verbose', action='store_true')
+    batch = parser.add_argument_group('Comparing many images',
+                                      'Compare pairs of directories or the pairs in a manifest using a process '
+                                      'pool. The exit status is the largest status of all the comparisons '
+                                      '(0 Equal, 1 NotEqual, 2 AffineMismatch, 3 Missing, 4 Failed).')
+    batch.add_argument('--manifest', type=Path,
+                       help='TSV file with "image1" and "image2" columns listing the pairs to compare.')
+    batch.add_argument('--pattern', type=str, default='*.nii*',
+                       help='Glob pattern selecting the images to compare (recursively) when comparing directories.')
+    batch.add_argument('--report', type=Path,
+                       help='Write a TSV report with the result, message, and misalignment of '
+                            'each comparison (default stdout).')
+    batch.add_argument('--nprocs', type=int,
+                       help='Number of worker processes (default number of CPUs)')
+    batch.add_argument('--batch_size', type=int, default=1,
+                       help='Number of pairs sent to a worker process at a time')
     return parser
 
 
 def main():
-    args = get_parser().parse_args()
-    result = compare(nibabel.load(args.image1), nibabel.load(args.image2),
-                     close=args.close, round_=args.round,
-                     intersection_only=args.intersection_only,
-                     round_offset=args.round_offset,
-                     normalize=args.normalize)
+    parser = get_parser()
+    args = parser.parse_args()
+    kwargs = dict(close=args.close, round_=args.round,
+                  intersection_only=args.intersection_only,
+                  round_offset=args.round_offset,
+                  normalize=args.normalize,
+                  chunk_size=args.chunk_size,
+                  byte_check=args.byte_check,
+                  diagnostics=args.diagnostics)
+    if args.manifest is not None:
+        if args.image1 is not None:
+            parser.error('image1 and image2 may not be used with --manifest')
+        pairs = read_manifest(args.manifest)
+    elif args.image1 is None or args.image2 is None:
+        parser.error('image1 and image2 are required unless --manifest is used')
+    elif os.path.isdir(args.image1) and os.path.isdir(args.image2):
+        pairs = pair_dirs(args.image1, args.image2, pattern=args.pattern)
+    else:
+        max_coords = args.max_coords if args.diff_coords is not None else 0
+        result = compare_files(args.image1, args.image2, max_coords=max_coords, **kwargs)
+        if args.verbose or args.diagnostics:
+            print(result)
+        if args.diff_coords is not None and result.diagnostics is not None:
+            with open(args.diff_coords, 'w', newline='') as f:
+                result.diagnostics.write_coords(f)
+        return result.status_code
+    results = compare_many(pairs, nprocs=args.nprocs, batch_size=args.batch_size, **kwargs)
+    if args.report is None:
+        write_report(sys.stdout, pairs, results)
+    else:
+        with open(args.report, 'w', newline='') as f:
+            write_report(f, pairs, results)
     if args.verbose:
-        print(result)
-    return result.status_code
+        print('{} of {} pairs equal'.format(sum(bool(r) for r in results), len(results)))
+    return max((r.status_code for r in results), default=0)
+
+
+def compare_files(file1, file2, **kwargs):
+    """Load and compare two image files. Returns :py:class:`Missing` if either file does not exist.
+    kwargs are passed to :py:func:`compare`."""
+    for file_ in [file1, file2]:
+        if file_ is None or not os.path.exists(file_):
+            return Missing('{} does not exist'.format(file_))
+    # keep the files open so compressed images are not decompressed from the start for every slab
+    return compare(nibabel.load(str(file1), keep_file_open=True), nibabel.load(str(file2), keep_file_open=True),
+                   **kwargs)
+
+
+def _compare_files_safe(pair, **kwargs):
+    try:
+        return compare_files(*pair, **kwargs)
+    except Exception as e:
+        return Failed('{}: {}'.format(type(e).__name__, e))
+
+
+def pair_dirs(dir1, dir2, pattern='*.nii*'):
+    """List (file1, file2) pairs of files matching pattern in dir1 and dir2 (searched recursively),
+    matched by their path relative to dir1 and dir2. If a file only exists in one directory,
+    the other element of the pair is None."""
+    relpaths = set()
+    for d in [dir1, dir2]:
+        relpaths.update(p.relative_to(d) for p in Path(d).rglob(pattern) if p.is_file())
+    pairs = []
+    for relpath in sorted(relpaths):
+        pairs.append(tuple(str(Path(d, relpath)) if Path(d, relpath).is_file() else None for d in [dir1, dir2]))
+    return pairs
+
+
+def read_manifest(manifest):
+    """Read (image1, image2) pairs from a TSV file with "image1" and "image2" columns"""
+    with open(manifest, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        if reader.fieldnames is None or not {'image1', 'image2'}.issubset(reader.fieldnames):
+            raise RuntimeError('manifest must have "image1" and "image2" columns')
+        return [(row['image1'], row['image2']) for row in reader]
+
+
+def compare_many(pairs, nprocs=None, batch_size=1, **kwargs):
+    """Compare many (file1, file2) pairs with :py:func:`compare_files` in a process pool.
+    Exceptions are returned as :py:class:`Failed` results. kwargs are passed to :py:func:`compare`."""
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        return list(executor.map(partial(_compare_files_safe, **kwargs), pairs, chunksize=batch_size))
+
+
+def write_report(f, pairs, results):
+    writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+    header = ['image1', 'image2', 'result', 'message', 'misalignment']
+    diagnostics = any(result.diagnostics is not None for result in results)
+    if diagnostics:
+        header.extend(['differing_voxels', 'max_abs_diff', 'max_rel_diff', 'bbox'])
+    writer.writerow(header)
+    for (file1, file2), result in zip(pairs, results):
+        if result.extra is None:
+            misalignment = 'n/a'
+        else:
+            misalignment = ','.join(str(m) for m in result.extra)
+        row = [file1 or 'n/a', file2 or 'n/a', result.name, result.desc, misalignment]
+        if diagnostics:
+            mismatches = result.diagnostics
+            if mismatches is None:
+                row.extend(['n/a'] * 4)
+            else:
+                bbox = ','.join(f'{lo}:{hi}' for lo, hi in mismatches.bbox())
+                row.extend([mismatches.count, mismatches.max_abs, mismatches.max_rel, bbox])
+        writer.writerow(row)
+
+
+def _equal(eqfuncstr, round_offset, aff1, aff2):
+    if round_offset:
+        misalignment = aff1[:3, -1] - aff2[:3, -1]
+        return Equal('Images equal (using {}). Misaligned by {}, {}, {} (in RAS).'.format(eqfuncstr, *misalignment),
+                     extra=misalignment)
+    else:
+        return Equal('Images equal (using {}).'.format(eqfuncstr))
 
 
-def compare(im1, im2, close=False, round_=False, intersection_only=False, round_offset=False, normalize=False):
+def compare(im1, im2, close=False, round_=False, intersection_only=False, round_offset=False, normalize=False,
+            chunk_size=CHUNK_SIZE, byte_check=False, diagnostics=False, max_coords=0):
+    """Compare two images. See :py:func:`get_parser` for a description of the options.
+
+    If diagnostics is True, differences where the images overlap do not stop the comparison. Instead
+    a :py:class:`Mismatches` summary (including the first max_coords differing values) is collected
+    in the same pass and attached to the :py:class:`NotEqual` result as its "diagnostics" attribute.
+    Non-zero data outside the overlap is still reported without diagnostics.
+    """
     if close and round_:
         raise ValueError('Only one of "close" and "round_" may be specified')
     checkoutside = not intersection_only
@@ -130,57 +529,75 @@ def compare(im1, im2, close=False, round_=False, intersection_only=False, round_
     else:
         eqfunc = alleq
         eqfuncstr = 'strict equality'
+    elemfunc = ELEMENTWISE[eqfunc]
     if normalize:
-        eqfunc = norm_comp(eqfunc)
         eqfuncstr += ' (normalized)'
-    if not (np.allclose(im1.affine, im2.affine) and im1.shape == im2.shape):
-        im1 = orient(im1)
-        im2 = orient(im2)
-        if not np.allclose(im1.affine[:3, :3], im2.affine[:3, :3]):
+    if np.allclose(im1.affine, im2.affine) and im1.shape == im2.shape:
+        if byte_check and not normalize and raw_equal(im1, im2):
+            return _equal('identical raw data', round_offset, im1.affine, im2.affine)
+        view1 = _RASView(im1, reorient=False)
+        view2 = _RASView(im2, reorient=False)
+        box1 = box2 = [(0, n) for n in view1.shape[:3]]
+    else:
+        view1 = _RASView(im1)
+        view2 = _RASView(im2)
+        if not np.allclose(view1.affine[:3, :3], view2.affine[:3, :3]):
             return AffineMismatch('Rotation and scaling do not match.')
-        im1_to_im2 = np.linalg.solve(im2.affine, im1.affine)
+        if view1.shape[3:] != view2.shape[3:]:
+            return NotEqual('Images have different non-spatial dimensions.')
+        im1_to_im2 = np.linalg.solve(view2.affine, view1.affine)
+        start1 = [0, 0, 0]
+        start2 = [0, 0, 0]
         for axes, offset in enumerate(im1_to_im2[:3, -1]):
             if not round_offset and not np.allclose(offset, int(np.around(offset))):
                 return AffineMismatch('Images are not offset an integer amount. Use the "round_offset" flag to ignore.')
             offset = int(np.around(offset))
             if offset < 0:
-                if checkoutside and not eqfunc(np.asarray(im1.dataobj)[tuple(slice(-offset) if axes == i else slice(None) for i in range(3))], 0):
-                    return NotEqual('Data outside the overlap is not zero. Use the "checkoutside" flag to ignore.')
-                im1 = im1.slicer[tuple(slice(-offset, None) if axes == i else slice(None) for i in range(3))]
-            elif offset > 0:
-                if checkoutside and not eqfunc(np.asarray(im2.dataobj)[tuple(slice(offset) if axes == i else slice(None) for i in range(3))], 0):
-                    return NotEqual('Data outside the overlap is not zero. Use the "checkoutside" flag to ignore.')
-                im2 = im2.slicer[tuple(slice(offset, None) if axes == i else slice(None) for i in range(3))]
-        shapediff = np.array(im2.shape) - np.array(im1.shape)
-        for axes, offset in enumerate(shapediff):
-            if offset < 0:
-                if checkoutside and not eqfunc(np.asarray(im1.dataobj)[tuple(slice(im2.shape[axes], None)
-                                                                             if axes == i else slice(None)
-                                                                             for i in range(3))],
-                                               0):
-                    return NotEqual('Data outside the overlap is not zero. Use the "checkoutside" flag to ignore.')
-                im1 = im1.slicer[tuple(slice(None, im2.shape[axes]) if axes == i else slice(None) for i in range(3))]
+                start1[axes] = min(-offset, view1.shape[axes])
             elif offset > 0:
-                if checkoutside and not eqfunc(np.asarray(im2.dataobj)[tuple(slice(im1.shape[axes], None)
-                                                                             if axes == i else slice(None)
-                                                                             for i in range(3))],
-                                               0):
-                    return NotEqual('Data outside the overlap is not zero. Use the "checkoutside" flag to ignore.')
-                im2 = im2.slicer[tuple(slice(None, im1.shape[axes]) if axes == i else slice(None) for i in range(3))]
-        assert np.allclose(im1.affine[:3, :3], im2.affine[:3, :3])  # use allclose in case of floating point error
+                start2[axes] = min(offset, view2.shape[axes])
+        size = [max(0, min(n1 - s1, n2 - s2)) for n1, s1, n2, s2 in zip(view1.shape, start1, view2.shape, start2)]
+        box1 = [(s, s + n) for s, n in zip(start1, size)]
+        box2 = [(s, s + n) for s, n in zip(start2, size)]
+        if checkoutside:
+            for view, box in [(view1, box1), (view2, box2)]:
+                for region in _outside(view.shape[:3], box):
+                    for chunk in view.chunks(region, chunk_size):
+                        if not eqfunc(chunk, 0):
+                            return NotEqual('Data outside the overlap is not zero. '
+                                            'Use the "checkoutside" flag to ignore.')
+        aff1 = view1.cropped_affine(box1)
+        aff2 = view2.cropped_affine(box2)
+        assert np.allclose(aff1[:3, :3], aff2[:3, :3])  # use allclose in case of floating point error
         if round_offset:
-            assert np.all(np.around(im1.affine[:3, -1]) == np.around(im2.affine[:3, -1]))
+            assert np.all(np.around(aff1[:3, -1]) == np.around(aff2[:3, -1]))
         else:
-            assert np.allclose(im1.affine[:3, -1], im2.affine[:3, -1])
-    if eqfunc(np.asarray(im1.dataobj), np.asarray(im2.dataobj)):
-        if round_offset:
-            misalignment = im1.affine[:3, -1] - im2.affine[:3, -1]
-            return Equal('Images equal (using {}). Misaligned by {}, {}, {} (in RAS).'.format(eqfuncstr, *misalignment),
-                         extra=misalignment)
+            assert np.allclose(aff1[:3, -1], aff2[:3, -1])
+    if normalize:
+        range1 = view1.range(box1, chunk_size)
+        range2 = view2.range(box2, chunk_size)
+        basefunc = eqfunc
+
+        def eqfunc(x, y):
+            return basefunc(norm(x, *range1), norm(y, *range2))
+    mismatches = Mismatches(max_coords=max_coords) if diagnostics else None
+    # iterate in the file order of the first image, so compressed files are read sequentially
+    slabs2 = view2.slabs(box2, chunk_size, axis=view1.slab_axis, reverse=view1.slab_reversed)
+    for slab1, slab2 in zip(view1.slabs(box1, chunk_size), slabs2):
+        chunk1 = view1.read(slab1)
+        chunk2 = view2.read(slab2)
+        if eqfunc(chunk1, chunk2):
+            continue
+        if mismatches is None:
+            return NotEqual('Images NOT equal (using {})'.format(eqfuncstr))
+        if normalize:
+            neq = ~elemfunc(norm(chunk1, *range1), norm(chunk2, *range2))
         else:
-            return Equal('Images equal (using {}).'.format(eqfuncstr))
-    else:
-        return NotEqual('Images NOT equal (using {})'.format(eqfuncstr))
+            neq = ~elemfunc(chunk1, chunk2)
+        mismatches.update(view1, slab1, chunk1, chunk2, neq)
+    if mismatches is not None and mismatches.count:
+        return NotEqual('Images NOT equal (using {}). {}'.format(eqfuncstr, mismatches), diagnostics=mismatches)
+    return _equal(eqfuncstr, round_offset, view1.cropped_affine(box1), view2.cropped_affine(box2))
 
 
 if __name__ == '__main__':
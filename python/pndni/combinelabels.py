@@ -1,9 +1,9 @@
 #!/bin/env python
 import argparse
-from functools import reduce
+import csv
 import nibabel
 import numpy as np
-from .utils import safeintload, copy_forms
+from .utils import safeint, copy_forms, slabs, CHUNK_SIZE, save_image, add_save_arguments
 
 
 def combine2labels(l1, l2):
@@ -12,6 +12,122 @@ def combine2labels(l1, l2):
     return out
 
 
+def _lexmax(columns, mask):
+    """Lexicographically largest tuple of values (most significant column first) where mask is True"""
+    best = []
+    for c in columns:
+        v = c[mask].max()
+        best.append(int(v))
+        mask = mask & (c == v)
+    return tuple(best)
+
+
+def label_radices(label_images, chunk_size=CHUNK_SIZE):
+    """Find the multiplier used for each step of ``reduce(combine2labels, label_images)``, i.e.,
+    the maximum of the combination of the first k + 1 images, for each k. The last value is the maximum
+    of the output.
+
+    Because the combined values are ordered like the tuples (l_k, ..., l_2, l_1) these maxima are found
+    in one pass over the data (in slabs).
+    """
+    shape = label_images[0].shape
+    if any(l.shape != shape for l in label_images):
+        raise ValueError('label images must all have the same shape')
+    nimages = len(label_images)
+    l1max = 0
+    best = [None] * nimages
+    for sl in slabs(shape, chunk_size):
+        slab = [safeint(np.asarray(l[sl])) for l in label_images]
+        if slab[0].size:
+            l1max = max(l1max, int(slab[0].max()))
+        valid = slab[0] != 0
+        for k in range(1, nimages):
+            valid &= slab[k] != 0
+            if not valid.any():
+                break
+            t = _lexmax(slab[k::-1], valid)
+            if best[k] is None or t > best[k]:
+                best[k] = t
+    # radices[k] is the maximum of the combination of the first k + 1 images
+    radices = [l1max]
+    for k in range(1, nimages):
+        if best[k] is None:
+            radices.append(0)
+        else:
+            t = best[k][::-1]
+            radices.append(t[0] + sum((t[j] - 1) * radices[j - 1] for j in range(1, k + 1)))
+    return radices
+
+
+def encode_labels(label_images, radices, chunk_size=CHUNK_SIZE):
+    """Combine label images using the multipliers found by :py:func:`label_radices`.
+    The output is allocated once, with the smallest type possible, and filled in slabs."""
+    shape = label_images[0].shape
+    nimages = len(label_images)
+    dtype = np.min_scalar_type(radices[-1])
+    # values are computed modulo the size of dtype; only voxels set to 0 can overflow
+    modulus = int(np.iinfo(dtype).max) + 1
+    out = np.empty(shape, dtype)
+    for sl in slabs(shape, chunk_size):
+        slab = [safeint(np.asarray(l[sl])) for l in label_images]
+        acc = out[sl]
+        acc[...] = slab[0]
+        valid = slab[0] != 0
+        for k in range(1, nimages):
+            valid &= slab[k] != 0
+            tmp = slab[k].astype(dtype)
+            tmp -= 1
+            tmp *= dtype.type(radices[k - 1] % modulus)
+            acc += tmp
+        if nimages > 1:
+            acc[~valid] = 0
+    return out
+
+
+def combine_labels(label_images, chunk_size=CHUNK_SIZE):
+    """Combine label images (arrays or array proxies of the same shape). The result is the same as
+    ``reduce(combine2labels, label_images)``, cast to the smallest type possible, but the inputs
+    are read in slabs (twice), and the output is allocated once."""
+    radices = label_radices(label_images, chunk_size=chunk_size)
+    return encode_labels(label_images, radices, chunk_size=chunk_size)
+
+
+def decode_labels(codes, radices):
+    """Find the input label tuple of each (non-zero) combined label in codes.
+    Returns an array with one row per code and one column per input image."""
+    nimages = len(radices)
+    rem = np.asarray(codes).astype(np.uint64)
+    out = np.empty((len(rem), nimages), dtype=np.uint64)
+    one = np.uint64(1)
+    for k in range(nimages - 1, 0, -1):
+        radix = np.uint64(radices[k - 1])
+        out[:, k] = (rem - one) // radix + one
+        rem = rem - (out[:, k] - one) * radix
+    out[:, 0] = rem
+    return out
+
+
+def compact_labels(out):
+    """Renumber the non-zero labels in out to 1..K, keeping their order.
+    Returns the renumbered image (of the smallest type possible) and the original label of
+    each new label."""
+    codes, inverse = np.unique(out, return_inverse=True)
+    if len(codes) and codes[0] == 0:
+        codes = codes[1:]
+    else:
+        inverse += 1
+    compact = inverse.astype(np.min_scalar_type(len(codes))).reshape(out.shape)
+    return compact, codes
+
+
+def write_label_table(f, labels, tuples, input_names):
+    """Write a TSV table mapping each output label to its input labels"""
+    writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+    writer.writerow(['label'] + list(input_names))
+    for label, row in zip(labels, tuples):
+        writer.writerow([int(label)] + [int(v) for v in row])
+
+
 def get_parser():
     parser = argparse.ArgumentParser(description="""Combine multiple label files into one, where output labels are the intersection
 of the input labels. For example, if labelfile1.nii and labelfile2.nii have the following
@@ -66,18 +182,37 @@ is equivalent to
     parser.add_argument('output_file', type=str, help='Output file name')
     input_files_help = ("input label files. each image must be of integer values >= 0")
     parser.add_argument('input_files', type=str, nargs='+', help=input_files_help)
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE,
+                        help='Maximum number of voxels read from each input file at once')
+    parser.add_argument('--compact', action='store_true',
+                        help='Renumber the label combinations that occur in the output to 1, 2, 3, ... '
+                             '(keeping their order). Use --label_table to record the combinations.')
+    parser.add_argument('--label_table', type=str,
+                        help='Write a TSV file with a "label" column containing each output label, '
+                             'and one column per input file (named by the file) with the corresponding input label.')
+    add_save_arguments(parser)
     return parser
 
 
 def main():
     args = get_parser().parse_args()
-    label_images = (safeintload(file_) for file_ in args.input_files)
-    out = reduce(combine2labels, label_images)
-    # reduce to smallest type possible
-    out = out.astype(np.min_scalar_type(out.max()), copy=False)
+    # keep the files open so compressed images are not decompressed from the start for every slab
+    label_images = [nibabel.load(file_, keep_file_open=True).dataobj for file_ in args.input_files]
+    radices = label_radices(label_images, chunk_size=args.chunk_size)
+    out = encode_labels(label_images, radices, chunk_size=args.chunk_size)
+    if args.compact:
+        out, codes = compact_labels(out)
+        labels = np.arange(1, len(codes) + 1)
+    elif args.label_table:
+        codes = np.unique(out)
+        codes = codes[codes > 0]
+        labels = codes
+    if args.label_table:
+        with open(args.label_table, 'w', newline='') as f:
+            write_label_table(f, labels, decode_labels(codes, radices), args.input_files)
     outnifti = nibabel.Nifti1Image(out, None)
     copy_forms(nibabel.load(args.input_files[0]), outnifti)
-    outnifti.to_filename(args.output_file)
+    save_image(outnifti, args.output_file, compresslevel=args.compresslevel, threads=args.compress_threads)
 
 
 if __name__ == '__main__':
@@ -1,50 +1,251 @@
 import argparse
 import csv
 from collections import namedtuple
-import re
+import itertools
+import json
+import nibabel
+import numpy as np
+import pandas as pd
 import os
+import sys
+from scipy.spatial import cKDTree
+from .utils import duplicates, split_ext, try_call
 
 
 SinglePoint = namedtuple('SinglePoint', ['x', 'y', 'z', 'index'])
 
 
+def sample_volume(data, ijk, interpolation='linear'):
+    """Sample the 3D array data at the (N, 3) voxel coordinates ijk, using 'linear' (trilinear)
+    or 'nearest' interpolation. Only the voxels needed are read, so data may be a memory-mapped array.
+    Points outside the volume are nan."""
+    if interpolation not in ['linear', 'nearest']:
+        raise ValueError(f'Unknown interpolation {interpolation}')
+    if data.ndim != 3:
+        raise ValueError('Only 3D images may be sampled')
+    ijk = np.asarray(ijk, dtype=np.float64).reshape(-1, 3)
+    shape = np.array(data.shape)
+    out = np.full(len(ijk), np.nan)
+    if interpolation == 'nearest':
+        vox = np.floor(ijk + 0.5).astype(np.int64)
+        inside = np.all((vox >= 0) & (vox < shape), axis=1)
+        out[inside] = data[tuple(vox[inside].T)]
+        return out
+    inside = np.all((ijk >= 0) & (ijk <= shape - 1), axis=1)
+    # points on the last slice of an axis use the previous voxel as the base, with weight 1 on the last
+    base = np.minimum(np.floor(ijk[inside]).astype(np.int64), np.maximum(shape - 2, 0))
+    frac = ijk[inside] - base
+    values = np.zeros(len(base))
+    for corner in itertools.product([0, 1], repeat=3):
+        weights = np.prod(np.where(corner, frac, 1.0 - frac), axis=1)
+        vox = np.minimum(base + corner, shape - 1)
+        values += weights * data[tuple(vox.T)]
+    out[inside] = values
+    return out
+
+
+def load_affine(filename):
+    """Load a 4x4 affine from a NIfTI image (its voxel to world affine) or a text file containing the matrix"""
+    filename = str(filename)
+    if filename.endswith('.nii') or filename.endswith('.nii.gz'):
+        return nibabel.load(filename).affine
+    affine = np.loadtxt(filename)
+    if affine.shape != (4, 4):
+        raise ValueError(f'{filename} does not contain a 4x4 matrix')
+    return affine
+
+
+# number of characters read from a tag file at once
+TAG_CHUNK_SIZE = 2 ** 20
+
+
+def _tag_token_chunks(f, chunk_size=TAG_CHUNK_SIZE):
+    """Read a tag file in chunks of whole lines, remove comments (from # or % to the end of the line),
+    and yield the whitespace separated tokens of each chunk as a list. "=" and ";" are separate tokens."""
+    leftover = ''
+    while True:
+        chunk = f.read(chunk_size)
+        text = leftover + chunk
+        if chunk:
+            cut = text.rfind('\n') + 1
+            text, leftover = text[:cut], text[cut:]
+        if '#' in text or '%' in text:
+            text = '\n'.join(line.split('#', 1)[0].split('%', 1)[0] for line in text.split('\n'))
+        tokens = text.replace(';', ' ; ').replace('=', ' = ').split()
+        if tokens:
+            yield tokens
+        if not chunk:
+            return
+
+
+def _append_rows(buf, n, rows):
+    """Copy rows into buf starting at row n, doubling the size of buf if needed. Returns buf"""
+    if n + len(rows) > len(buf):
+        new = np.empty((max(2 * len(buf), n + len(rows)),) + buf.shape[1:], dtype=buf.dtype)
+        new[:n] = buf[:n]
+        buf = new
+    buf[n:n + len(rows)] = rows
+    return buf
+
+
+def read_minc_tag(f, chunk_size=TAG_CHUNK_SIZE):
+    """Read the points of an open tag file f, chunk_size characters at a time.
+    Each point must be x y z (followed by x2 y2 z2 if the file has 2 volumes), optionally
+    weight, structure ID, and patient ID, and then a quoted integer label.
+    Returns an (N, 3) array of coordinates (of the first volume) and a length N array of labels."""
+    if f.readline().strip() != 'MNI Tag Point File':
+        raise RuntimeError('First line of a tag file must be "MNI Tag Point File"')
+    chunks = _tag_token_chunks(f, chunk_size)
+    tokens = []
+    pos = 0
+
+    def next_token():
+        nonlocal tokens, pos
+        while pos >= len(tokens):
+            tokens = next(chunks, None)
+            if tokens is None:
+                raise RuntimeError('Unexpected end of tag file')
+            pos = 0
+        pos += 1
+        return tokens[pos - 1]
+
+    header = {}
+    while True:
+        key = next_token()
+        if next_token() != '=':
+            raise RuntimeError(f'Expected "=" after {key} in tag file')
+        if key == 'Points':
+            break
+        values = []
+        while True:
+            value = next_token()
+            if value == ';':
+                break
+            values.append(value)
+        header[key] = ' '.join(values)
+    if header.get('Volumes') not in ['1', '2']:
+        raise RuntimeError('Tag file must have "Volumes = 1;" or "Volumes = 2;"')
+    ncoords = 3 * int(header['Volumes'])
+
+    coords = np.empty((1024, 3))
+    index = np.empty(1024, dtype=np.int64)
+    npoints = 0
+    # fields of a point that was split between chunks
+    pending = []
+    tokens = tokens[pos:]
+    done = False
+    while not done:
+        if ';' in tokens:
+            tokens = tokens[:tokens.index(';')]
+            done = True
+        fields = pending + tokens
+        ends = [i for i, field in enumerate(fields) if field[0] == '"']
+        starts = [0] + [end + 1 for end in ends[:-1]]
+        if any(end - start not in [ncoords, ncoords + 3] for start, end in zip(starts, ends)):
+            raise RuntimeError(f'Each point in a tag file with {ncoords // 3} volume(s) must have '
+                               f'{ncoords + 1} or {ncoords + 4} fields')
+        labels = [fields[end] for end in ends]
+        if not all(len(label) > 1 and label[-1] == '"' for label in labels):
+            raise RuntimeError("index must be surrounded by quotes")
+        xyz = [fields[start:start + 3] for start in starts]
+        coords = _append_rows(coords, npoints, np.array(xyz, dtype=np.float64).reshape(-1, 3))
+        index = _append_rows(index, npoints, [int(label[1:-1]) for label in labels])
+        npoints += len(labels)
+        pending = fields[ends[-1] + 1:] if ends else fields
+        if not done:
+            tokens = next(chunks, None)
+            if tokens is None:
+                raise RuntimeError('Tag file points must end with ";"')
+    if pending:
+        raise RuntimeError('Each point in a tag file must end with a quoted label')
+    return coords[:npoints].copy(), index[:npoints].copy()
+
+
+def _column_name(filename):
+    return split_ext(os.path.basename(str(filename)), ['.nii.gz', '.nii'])[0]
+
+
 class Points(object):
     _FCSV_HEADER = ['# Markups fiducial file version = 4.10.2',
                     '# CoordinateSystem = 0',  # RAS
                     '# columns = id,x,y,z,label']
+    _NPY_DTYPE = np.dtype([('x', np.float64), ('y', np.float64), ('z', np.float64), ('index', np.int64)])
+    _MRK_JSON_SCHEMA = ('https://raw.githubusercontent.com/slicer/slicer/master/Modules/Loadable/Markups/'
+                        'Resources/Schema/markups-schema-v1.0.0.json#')
 
     def __init__(self, points):
-        """points is a list or tuple of SinglePoints"""
-        self.points = tuple(points)
+        """points is a list or tuple of SinglePoints. See also :py:meth:`from_arrays`"""
+        points = list(points)
+        self.coords = np.array([[point.x, point.y, point.z] for point in points], dtype=np.float64).reshape(-1, 3)
+        self.index = np.array([point.index for point in points], dtype=np.int64)
+        self.columns = {}
+
+    @classmethod
+    def from_arrays(cls, coords, index):
+        """Initialize points from an (N, 3) array of x, y, z coordinates and a length N array of integer indices"""
+        out = cls.__new__(cls)
+        out.coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+        out.index = np.array(index, dtype=np.int64).reshape(-1)
+        if len(out.coords) != len(out.index):
+            raise ValueError('coords and index must have the same length')
+        out.columns = {}
+        return out
+
+    def transform(self, affine):
+        """Return new Points with the 4x4 affine applied to all coordinates. Extra columns are kept."""
+        affine = np.asarray(affine, dtype=np.float64)
+        out = self.from_arrays(self.coords @ affine[:3, :3].T + affine[:3, 3], self.index)
+        out.columns = dict(self.columns)
+        return out
+
+    def voxel_to_world(self, img):
+        """Treat the coordinates as voxel indices of img and return Points in img's world (RAS) space"""
+        return self.transform(img.affine)
+
+    def world_to_voxel(self, img):
+        """Return Points with the coordinates converted from world (RAS) space to voxel indices of img"""
+        return self.transform(np.linalg.inv(img.affine))
+
+    def sample(self, img, interpolation='linear'):
+        """Sample the 3D image img at each (world space) point. See :py:func:`sample_volume`"""
+        ijk = self.world_to_voxel(img).coords
+        return sample_volume(np.asanyarray(img.dataobj), ijk, interpolation=interpolation)
+
+    def add_column(self, name, values):
+        """Add a column of values (one per point), which will be written to TSV files after index"""
+        values = np.asarray(values)
+        if values.shape != (len(self),):
+            raise ValueError('values must have one entry per point')
+        if name in SinglePoint._fields:
+            raise ValueError(f'{name} is a reserved column name')
+        self.columns[name] = values
+
+    @property
+    def points(self):
+        """The points as a tuple of SinglePoints"""
+        return tuple(SinglePoint(*coord, index) for coord, index in zip(self.coords.tolist(), self.index.tolist()))
+
+    def _columns(self):
+        """x, y, z, and index as lists of python floats and ints"""
+        return self.coords[:, 0].tolist(), self.coords[:, 1].tolist(), self.coords[:, 2].tolist(), self.index.tolist()
+
+    @classmethod
+    def _from_table(cls, infile, sep, names=None, usecols=('x', 'y', 'z', 'index')):
+        """Read columns usecols (naming x, y, z, and index) of a delimited file"""
+        x, y, z, index = usecols
+        df = pd.read_csv(infile, sep=sep, names=names, usecols=list(usecols), index_col=False,
+                         float_precision='round_trip', dtype={x: np.float64, y: np.float64, z: np.float64,
+                                                              index: np.int64})
+        return cls.from_arrays(df[[x, y, z]].to_numpy(np.float64), df[index].to_numpy(np.int64))
 
     @classmethod
     def from_file(cls, infile):
-        """Initialize points from file, choosing the format based on the extension"""
-        ext = os.path.splitext(infile)[1]
-        if ext == '.tsv':
-            return cls.from_tsv(infile)
-        elif ext == '.csv':
-            return cls.from_ants_csv(infile)
-        elif ext == '.tag':
-            return cls.from_minc_tag(infile)
-        elif ext == '.fcsv':
-            return cls.from_fcsv(infile)
-        else:
-            raise RuntimeError('Unsupported file type')
+        """Initialize points from file, choosing the reader based on the extension. See :py:func:`register_format`"""
+        return READERS[_format_ext(infile, READERS)](infile)
 
     def to_file(self, outfile):
-        """Write to file, choosing the type based on the extension"""
-        ext = os.path.splitext(outfile)[1]
-        if ext == '.tsv':
-            return self.to_tsv(outfile)
-        elif ext == '.csv':
-            return self.to_ants_csv(outfile)
-        elif ext == '.tag':
-            return self.to_minc_tag(outfile)
-        elif ext == '.fcsv':
-            return self.to_fcsv(outfile)
-        else:
-            raise RuntimeError('Unsupported file type')
+        """Write to file, choosing the writer based on the extension. See :py:func:`register_format`"""
+        return WRITERS[_format_ext(outfile, WRITERS)](self, outfile)
 
     def to_fcsv(self, outfile):
         """Write data to a Slicer fidicial file
@@ -53,8 +254,7 @@ class Points(object):
         with open(outfile, 'w', newline='') as f:
             f.write('\n'.join(self._FCSV_HEADER) + '\n')
             writer = csv.writer(f)
-            for i, point in enumerate(self.points):
-                writer.writerow([i, point.x, point.y, point.z, point.index])
+            writer.writerows(zip(range(len(self)), *self._columns()))
 
     @classmethod
     def from_fcsv(cls, infile):
@@ -66,35 +266,29 @@ class Points(object):
                 lt = f.readline().strip()
                 if lt != cls._FCSV_HEADER[i]:
                     raise RuntimeError(f'Line {i + 1} of fcsv must be {cls._FCSV_HEADER[i]}')
-            reader = csv.reader(f)
-            points = [SinglePoint(float(row[1]),
-                                  float(row[2]),
-                                  float(row[3]),
-                                  int(row[4]))
-                      for row in reader]
-            return cls(points)
+            start = f.tell()
+            if not f.read(1):
+                return cls([])
+            f.seek(start)
+            names = ['id', 'x', 'y', 'z', 'label']
+            return cls._from_table(f, ',', names=names, usecols=names[1:])
 
     def to_tsv(self, outfile):
-        """Write the data to a TSV file"""
+        """Write the data to a TSV file, followed by any extra columns (see :py:meth:`add_column`).
+        Missing (nan) values are written as n/a"""
+        # nan != nan
+        extra = [['n/a' if v != v else v for v in values.tolist()] for values in self.columns.values()]
         with open(outfile, 'w', newline='') as f:
-            writer = csv.DictWriter(f, delimiter='\t', fieldnames=SinglePoint._fields)
-            writer.writeheader()
-            for point in self.points:
-                writer.writerow(point._asdict())
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(list(SinglePoint._fields) + list(self.columns))
+            writer.writerows(zip(*self._columns(), *extra))
 
     @classmethod
     def from_tsv(cls, infile):
         """Initialize Points object from a TSV file with "x", "y", "z", and "index"
         columns (of types float, float, float, and int, respectively). All other
         columns will be ignored"""
-        with open(infile, 'r', newline='') as f:
-            reader = csv.DictReader(f, delimiter='\t')
-            points = [SinglePoint(float(row['x']),
-                                  float(row['y']),
-                                  float(row['z']),
-                                  int(row['index']))
-                      for row in reader]
-        return cls(points)
+        return cls._from_table(infile, '\t')
 
     def to_ants_csv(self, outfile):
         """Write an ANTS style CSV file. The t column is set to 0.0.
@@ -102,14 +296,10 @@ class Points(object):
         (ants uses LPS while this class uses RAS).
         """
         with open(outfile, 'w', newline='') as f:
-            writer = csv.DictWriter(f, delimiter=',', fieldnames=list(SinglePoint._fields) + ['t'])
-            writer.writeheader()
-            for point in self.points:
-                writer.writerow({'x': -1.0 * point.x,
-                                 'y': -1.0 * point.y,
-                                 'z': point.z,
-                                 'index': point.index,
-                                 't': 0.0})
+            writer = csv.writer(f, delimiter=',')
+            writer.writerow(list(SinglePoint._fields) + ['t'])
+            lps = self.coords * [-1.0, -1.0, 1.0]
+            writer.writerows(zip(*lps.T.tolist(), self.index.tolist(), [0.0] * len(self)))
 
     @classmethod
     def from_ants_csv(cls, infile):
@@ -117,15 +307,8 @@ class Points(object):
         columns (of types float, float, float, and int, respectively). All other
         columns will be ignored. The x and y columns will be multiplied by -1.0
         (ants uses LPS while this class uses RAS)."""
-        with open(infile, 'r', newline='') as f:
-            reader = csv.DictReader(f, delimiter=',')
-            points = []
-            for row in reader:
-                points.append(SinglePoint(-1.0 * float(row['x']),
-                                          -1.0 * float(row['y']),
-                                          float(row['z']),
-                                          int(row['index'])))
-        return cls(points)
+        lps = cls._from_table(infile, ',')
+        return cls.from_arrays(lps.coords * [-1.0, -1.0, 1.0], lps.index)
 
     def to_minc_tag(self, outfile):
         """Write a
@@ -133,46 +316,211 @@ class Points(object):
         the weight, structure ID, and patient ID are set to 0, -1, and -1, respectively"""
         with open(outfile, 'w') as f:
             f.write('MNI Tag Point File\nVolumes = 1;\nPoints =')
-            for i, point in enumerate(self.points):
-                f.write(f'\n {point.x} {point.y} {point.z} 0 -1 -1 "{point.index}"')
+            f.writelines(f'\n {x} {y} {z} 0 -1 -1 "{index}"' for x, y, z, index in zip(*self._columns()))
             f.write(';\n')
 
     @classmethod
-    def from_minc_tag(cls, infile):
+    def from_minc_tag(cls, infile, chunk_size=TAG_CHUNK_SIZE):
         """Initialize Points object from a
         '`minc tag file <https://en.wikibooks.org/wiki/MINC/SoftwareDevelopment/Tag_file_format_reference>`_'.
-        In this case, we assume each point has 7 parameters, and that the text label is quoted. Therefore
-        it is more restrictive than the linked specification. All information besides x, y, z, and label
-        are ignored.
+        In this case, we assume each point has a quoted integer label, with or without the weight,
+        structure ID, and patient ID. Therefore it is more restrictive than the linked specification.
+        All information besides x, y, z (of the first volume), and label are ignored.
+        The file is read chunk_size characters at a time. See :py:func:`read_minc_tag`.
         """
-        points = []
         with open(infile, 'r') as f:
-            contents = f.read()
-            # remove comments
-            contents = re.sub('[#%][^\n]*\n', '\n', contents)
-            match = re.match(r'MNI Tag Point File\n+Volumes = [12];\n+\s*Points =([^;]*);', contents)
-            pointsstr = match.group(1)
-            pointssplit = pointsstr.split()
-            npoints = len(pointssplit) // 7
-            if npoints != len(pointssplit) / 7.0:
-                raise RuntimeError('MNI Tags file must have 7 fields per point')
-            for i in range(npoints):
-                row = pointssplit[i * 7:(i + 1) * 7]
-                index = row[6]
-                if index[0] != '"' or index[-1] != '"':
-                    raise RuntimeError("index must be surrounded by quotes")
-                index = index[1:-1]
-                points.append(SinglePoint(float(row[0]),
-                                          float(row[1]),
-                                          float(row[2]),
-                                          int(index)))
-        return cls(points)
+            coords, index = read_minc_tag(f, chunk_size=chunk_size)
+        return cls.from_arrays(coords, index)
+
+    def to_npy(self, outfile):
+        """Write a numpy .npy file containing a structured array with fields x, y, z, and index"""
+        out = np.empty(len(self), dtype=self._NPY_DTYPE)
+        out['x'], out['y'], out['z'] = self.coords.T
+        out['index'] = self.index
+        np.save(outfile, out)
+
+    @classmethod
+    def from_npy(cls, infile):
+        """Initialize Points object from a numpy .npy file written by :py:meth:`to_npy`"""
+        data = np.load(infile, allow_pickle=False)
+        if data.dtype.names is None or not set(SinglePoint._fields) <= set(data.dtype.names):
+            raise RuntimeError('npy file must contain a structured array with fields x, y, z, and index')
+        return cls.from_arrays(np.stack([data['x'], data['y'], data['z']], axis=1), data['index'])
+
+    def to_npz(self, outfile):
+        """Write a numpy .npz file containing a coords (N, 3) array and an index array"""
+        np.savez(outfile, coords=self.coords, index=self.index)
+
+    @classmethod
+    def from_npz(cls, infile):
+        """Initialize Points object from a numpy .npz file with coords and index arrays"""
+        with np.load(infile, allow_pickle=False) as data:
+            return cls.from_arrays(data['coords'], data['index'])
+
+    def to_bids_json(self, outfile):
+        """Write a BIDS style JSON file with an "AnatomicalLandmarkCoordinates" object mapping each
+        index to its coordinates. Indices must be unique."""
+        if len(np.unique(self.index)) != len(self):
+            raise ValueError('Indices must be unique to write a BIDS JSON file')
+        landmarks = {str(index): coord for index, coord in zip(self.index.tolist(), self.coords.tolist())}
+        with open(outfile, 'w') as f:
+            json.dump({'AnatomicalLandmarkCoordinates': landmarks}, f, indent=4)
+            f.write('\n')
+
+    @classmethod
+    def from_bids_json(cls, infile):
+        """Initialize Points object from the "AnatomicalLandmarkCoordinates" of a BIDS style JSON file.
+        The landmark names must be integers. All other keys are ignored."""
+        with open(infile, 'r') as f:
+            landmarks = json.load(f)['AnatomicalLandmarkCoordinates']
+        return cls.from_arrays([landmarks[name] for name in landmarks], [int(name) for name in landmarks])
+
+    def to_mrk_json(self, outfile):
+        """Write a `slicer markups json file <https://slicer.readthedocs.io/en/latest/developer_guide/modules/markups.html>`_
+        with one fiducial list. Coordinates are written in RAS."""
+        control_points = [{'id': str(i + 1), 'label': str(index), 'position': coord}
+                          for i, (index, coord) in enumerate(zip(self.index.tolist(), self.coords.tolist()))]
+        with open(outfile, 'w') as f:
+            json.dump({'@schema': self._MRK_JSON_SCHEMA,
+                       'markups': [{'type': 'Fiducial', 'coordinateSystem': 'RAS',
+                                    'controlPoints': control_points}]}, f, indent=4)
+            f.write('\n')
+
+    @classmethod
+    def from_mrk_json(cls, infile):
+        """Initialize Points object from the control points of all markups in a slicer markups json file.
+        Labels must be integers. LPS coordinates (the default) are converted to RAS."""
+        with open(infile, 'r') as f:
+            markups = json.load(f)['markups']
+        coords = []
+        index = []
+        for markup in markups:
+            points = markup.get('controlPoints', [])
+            xyz = np.array([point['position'] for point in points], dtype=np.float64).reshape(-1, 3)
+            if markup.get('coordinateSystem', 'LPS') == 'LPS':
+                xyz *= [-1.0, -1.0, 1.0]
+            coords.append(xyz)
+            index.extend(int(point['label']) for point in points)
+        return cls.from_arrays(np.concatenate(coords) if coords else [], index)
+
+    @property
+    def kdtree(self):
+        """A scipy.spatial.cKDTree of the coordinates, built on first use and then cached
+        (so coords should not be modified in place afterwards)"""
+        if getattr(self, '_kdtree', None) is None:
+            self._kdtree = cKDTree(self.coords)
+        return self._kdtree
+
+    def nearest(self, other, k=1):
+        """For each point of other (Points or an (M, 3) array), find the k nearest of these points.
+        Returns the distances and the positions (in these points) of the neighbours, as from cKDTree.query"""
+        coords = other.coords if isinstance(other, Points) else np.asarray(other, dtype=np.float64).reshape(-1, 3)
+        return self.kdtree.query(coords, k=k)
+
+    def within(self, other, r):
+        """For each point of other (Points or an (M, 3) array), return an array of the positions of these points
+        within distance r of it"""
+        coords = other.coords if isinstance(other, Points) else np.asarray(other, dtype=np.float64).reshape(-1, 3)
+        return [np.array(positions, dtype=np.int64) for positions in self.kdtree.query_ball_point(coords, r)]
+
+    def matched_distances(self, other):
+        """Match these points to the points of other with the same index (indices must be unique in both).
+        Returns the matched indices (in the order of these points), the distances between the matched points,
+        and the (M, 3) differences (other minus these points)."""
+        if len(np.unique(self.index)) != len(self) or len(np.unique(other.index)) != len(other):
+            raise ValueError('Indices must be unique to match points')
+        _, pos, other_pos = np.intersect1d(self.index, other.index, assume_unique=True, return_indices=True)
+        order = np.argsort(pos)
+        pos, other_pos = pos[order], other_pos[order]
+        diff = other.coords[other_pos] - self.coords[pos]
+        return self.index[pos], np.sqrt(np.sum(diff ** 2, axis=1)), diff
 
     def __len__(self):
-        return len(self.points)
+        return len(self.index)
 
     def __eq__(self, other):
-        return len(self) == len(other) and self.points == other.points
+        return (len(self) == len(other) and np.array_equal(self.coords, other.coords)
+                and np.array_equal(self.index, other.index))
+
+
+# readers take a file name and return Points, and writers take Points and a file name
+READERS = {}
+WRITERS = {}
+
+
+def register_format(ext, reader=None, writer=None):
+    """Register a reader and/or writer for files ending in ext (e.g. ".tsv"), used by
+    :py:meth:`Points.from_file` and :py:meth:`Points.to_file`. If several extensions match a file,
+    the longest is used."""
+    if reader is not None:
+        READERS[ext] = reader
+    if writer is not None:
+        WRITERS[ext] = writer
+
+
+def _format_ext(filename, registry):
+    ext = split_ext(filename, registry)[1]
+    if not ext:
+        raise RuntimeError('Unsupported file type')
+    return ext
+
+
+for _ext, _reader, _writer in [('.tsv', Points.from_tsv, Points.to_tsv),
+                               ('.csv', Points.from_ants_csv, Points.to_ants_csv),
+                               ('.tag', Points.from_minc_tag, Points.to_minc_tag),
+                               ('.fcsv', Points.from_fcsv, Points.to_fcsv),
+                               ('.npy', Points.from_npy, Points.to_npy),
+                               ('.npz', Points.from_npz, Points.to_npz),
+                               ('.json', Points.from_bids_json, Points.to_bids_json),
+                               ('.mrk.json', Points.from_mrk_json, Points.to_mrk_json)]:
+    register_format(_ext, _reader, _writer)
+
+
+def batch_outputs(infile, output_dir, output_exts):
+    """Return the output file names in output_dir for infile, one for each extension in output_exts"""
+    name = os.path.basename(str(infile))
+    name = name[:-len(_format_ext(name, READERS))]
+    return [os.path.join(output_dir, name + ext) for ext in output_exts]
+
+
+def landmark_errors(reference, points):
+    """Compare points to reference landmarks. Returns a DataFrame with one row per reference landmark and columns
+    index, distance (to the point in points with the same index), dx, dy, dz (points minus reference),
+    nearest_index (the index of the reference landmark nearest to the matched point) and nearest_distance.
+    Landmarks missing from points have missing values."""
+    index, distances, diff = reference.matched_distances(points)
+    nearest_distance, nearest = reference.nearest(points)
+    matched = pd.DataFrame({'index': index, 'distance': distances, 'dx': diff[:, 0], 'dy': diff[:, 1],
+                            'dz': diff[:, 2]})
+    nearest = pd.DataFrame({'index': points.index, 'nearest_index': reference.index[nearest],
+                            'nearest_distance': nearest_distance})
+    out = pd.DataFrame({'index': reference.index}).merge(matched, on='index', how='left')
+    return out.merge(nearest, on='index', how='left')
+
+
+def get_errors_parser():
+    parser = argparse.ArgumentParser(prog='landmarkerrors',
+                                     description='Compare landmark files to reference landmarks, matched by index, '
+                                                 'and write a TSV table of the errors for each landmark. The table has '
+                                                 'columns file, index, distance, dx, dy, dz (file minus reference), '
+                                                 'nearest_index (the reference landmark nearest to the file\'s '
+                                                 'landmark), and nearest_distance. Landmarks missing from a file '
+                                                 'have values n/a.')
+    parser.add_argument('reference', type=str, help='Reference landmark file (any format supported by convertpoints)')
+    parser.add_argument('points', type=str, nargs='+', help='Landmark files to compare to the reference')
+    parser.add_argument('--output', type=str, required=True, help='Output TSV file')
+    return parser
+
+
+def errors_main():
+    args = get_errors_parser().parse_args()
+    reference = Points.from_file(args.reference)
+    tables = []
+    for filename in args.points:
+        table = landmark_errors(reference, Points.from_file(filename))
+        table.insert(0, 'file', filename)
+        tables.append(table)
+    pd.concat(tables).to_csv(args.output, sep='\t', index=False, na_rep='n/a')
 
 
 def get_parser():
@@ -190,23 +538,96 @@ columns (of types float, float, float, and int, respectively). All other
 columns will be ignored. Coordinates are in LPS.
 
 A `minc tag file <https://en.wikibooks.org/wiki/MINC/SoftwareDevelopment/Tag_file_format_reference>`_ (extension .tag).
-In this case, we assume each point has 7 parameters, and that the text label is quoted. Therefore
-it is more restrictive than the linked specification. All information besides x, y, z, and label
-are ignored. Coordinates are in RAS.
+In this case, we assume each point has a quoted integer label, with or without the weight,
+structure ID, and patient ID. Therefore it is more restrictive than the linked specification.
+All information besides x, y, z (of the first volume), and label are ignored. Coordinates are in RAS.
 
 A `slicer fiducial file <https://www.slicer.org/wiki/Documentation/Nightly/Modules/Markups#File_Format>`_ (extension .fcsv')
 Containing only the columns id, x, y, z, label (int, float, float, float, and int, respectively). Id is ignored.
 Coordinates are in RAS.
-                        """)
-    parser.add_argument('outfile', type=str,
-                        help='Output file. Format determined by extension. See infile.')
+
+A numpy file (extension .npy) containing a structured array with fields x, y, z, and index,
+or (extension .npz) containing an (N, 3) array "coords" and an array "index". Coordinates are in RAS.
+
+A BIDS style JSON file (extension .json) whose "AnatomicalLandmarkCoordinates" maps integer names to
+coordinates. Coordinates are in RAS (use --transform and --invert with an image to write voxel coordinates).
+
+A `slicer markups json file <https://slicer.readthedocs.io/en/latest/developer_guide/modules/markups.html>`_
+(extension .mrk.json). Labels must be integers. LPS or RAS coordinates are read, and RAS are written.
+
+Omit if --batch is used.
+                        """, nargs='?')
+    parser.add_argument('outfile', type=str, nargs='?',
+                        help='Output file. Format determined by extension. See infile. Omit if --batch is used.')
+    parser.add_argument('--batch', type=str, nargs='+',
+                        help='Convert all these files (reading each once) to each extension in --output_ext, '
+                             'writing them to --output_dir. Failures are reported without stopping the other files. '
+                             'Inputs whose outputs would have the same name are an error.')
+    parser.add_argument('--output_dir', type=str, help='Output directory used with --batch')
+    parser.add_argument('--output_ext', type=str, nargs='+', help='Output extensions used with --batch')
+    parser.add_argument('--transform', type=str,
+                        help='Apply this affine to the points before writing them. Either a text file containing '
+                             'a 4x4 matrix, or a NIfTI image whose voxel to world affine is used '
+                             '(so the points are treated as voxel indices).')
+    parser.add_argument('--invert', action='store_true',
+                        help='Apply the inverse of --transform (e.g. to convert world coordinates to voxel indices '
+                             'of a NIfTI image)')
+    parser.add_argument('--sample', type=str, nargs='+',
+                        help='Sample these 3D images at the (transformed) points and write the values as extra '
+                             'columns, named by the image file names. All outputs must be TSV files.')
+    parser.add_argument('--interpolation', type=str, choices=['linear', 'nearest'], default='linear',
+                        help='Interpolation used with --sample')
     return parser
 
 
+def _convert(infile, outfiles, affine, images, interpolation):
+    """Convert infile to each of outfiles, sampling each (file name, data array, affine) in images"""
+    points = Points.from_file(infile)
+    if affine is not None:
+        points = points.transform(affine)
+    for filename, data, image_affine in images:
+        ijk = points.transform(np.linalg.inv(image_affine)).coords
+        points.add_column(_column_name(filename), sample_volume(data, ijk, interpolation=interpolation))
+    for outfile in outfiles:
+        points.to_file(outfile)
+
+
 def main():
-    args = get_parser().parse_args()
-    Points.from_file(args.infile).to_file(args.outfile)
+    parser = get_parser()
+    args = parser.parse_args()
+    affine = None
+    if args.transform:
+        affine = load_affine(args.transform)
+        if args.invert:
+            affine = np.linalg.inv(affine)
+    if args.sample:
+        outputs = args.output_ext if args.batch else [args.outfile]
+        if any(split_ext(output, WRITERS)[1] != '.tsv' for output in outputs or []):
+            parser.error('--sample columns can only be written to .tsv outputs')
+    # load the image data once, for all files (a compressed image would otherwise be decompressed for each file)
+    images = []
+    for filename in args.sample or []:
+        img = nibabel.load(filename)
+        images.append((filename, np.asanyarray(img.dataobj), img.affine))
+    if args.batch:
+        if args.infile is not None or args.output_dir is None or args.output_ext is None:
+            parser.error('--batch requires --output_dir and --output_ext, and infile and outfile may not be used')
+        outputs = [batch_outputs(infile, args.output_dir, args.output_ext) for infile in args.batch]
+        same = duplicates(outfile for outfiles in outputs for outfile in outfiles)
+        if same:
+            parser.error('--batch inputs would write to the same outputs: ' + ', '.join(sorted(set(same))))
+        os.makedirs(args.output_dir, exist_ok=True)
+        failed = 0
+        for infile, outfiles in zip(args.batch, outputs):
+            _, message = try_call(_convert, infile, outfiles, affine, images, args.interpolation)
+            if message is not None:
+                print(f'{infile}: {message}', file=sys.stderr)
+                failed += 1
+        return 1 if failed else 0
+    if args.outfile is None:
+        parser.error('infile and outfile are required unless --batch is used')
+    _convert(args.infile, [args.outfile], affine, images, args.interpolation)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
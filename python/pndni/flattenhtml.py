@@ -1,68 +1,386 @@
 import argparse
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from html.parser import HTMLParser
+import io
+import itertools
+import os
 from pathlib import Path
 import base64
+import sys
+import time
+from .utils import duplicates, try_call
+
+
+# number of bytes of an image encoded at once (a multiple of 3, so the chunks can be concatenated)
+ENCODE_CHUNK_SIZE = 3 * 2 ** 16
+# buffer size of the output file
+BUFFER_SIZE = 2 ** 20
+# default size (in bytes of data URIs) of the image cache shared by the reports in a directory
+CACHE_BYTES = 2 ** 26
+MIME_TYPES = {'.png': 'image/png',
+              '.jpg': 'image/jpeg',
+              '.jpeg': 'image/jpeg',
+              '.gif': 'image/gif',
+              '.svg': 'image/svg+xml'}
+
+
+def mime_type(src):
+    """Return the mime type of the image src, based on its extension"""
+    mtype = MIME_TYPES.get(os.path.splitext(src)[1].lower())
+    if mtype is None:
+        raise RuntimeError('Only {} supported. {}'.format(', '.join(MIME_TYPES), src))
+    return mtype
+
+
+def write_base64(infile, out, chunk_size=ENCODE_CHUNK_SIZE):
+    """base64 encode the contents of the file infile, and write it to the text stream out,
+    reading chunk_size bytes at a time. Returns the number of characters written."""
+    if chunk_size % 3:
+        raise ValueError('chunk_size must be a multiple of 3')
+    nchars = 0
+    with open(infile, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            nchars += out.write(base64.b64encode(chunk).decode('ascii'))
+    return nchars
+
+
+def encode_image(infile, mtype):
+    """Return the data URI of the image infile, of mime type mtype"""
+    out = io.StringIO()
+    out.write(f'data:{mtype};base64,')
+    write_base64(infile, out)
+    return out.getvalue()
+
+
+class ImageCache(object):
+
+    def __init__(self, executor=None, window=2, max_bytes=CACHE_BYTES):
+        """Data URIs of images, keyed on the resolved path, modification time, and size of each file, so an image
+        shared by many html files is only read and encoded once (or again if it changes). Before each html file,
+        :py:meth:`plan` is given the images it uses, in order, and :py:meth:`get` is then called for each of them
+        in that order. If executor (e.g. a ThreadPoolExecutor) is given, the next window images are encoded in it
+        ahead of their use.
+
+        Images are kept while they are used again later in the current html file. Beyond that, the least
+        recently used images are dropped once the cache holds more than max_bytes of data URIs."""
+        self.executor = executor
+        self.window = window
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self.plan([])
+
+    @staticmethod
+    def _key(path):
+        path = Path(path).resolve()
+        st = path.stat()
+        return (str(path), st.st_mtime_ns, st.st_size)
+
+    def _encode(self, path, mtype):
+        if self.executor is None:
+            future = Future()
+            future.set_result(encode_image(path, mtype))
+            return future
+        return self.executor.submit(encode_image, path, mtype)
+
+    def _prefetch(self):
+        if self.executor is None:
+            return
+        for key, mtype in itertools.islice(self._upcoming, self.window):
+            if key not in self._images:
+                self._images[key] = self._encode(key[0], mtype)
+
+    def _evict(self):
+        sizes = {}
+        for key, future in list(self._images.items()):
+            if future.done():
+                if future.exception() is not None:
+                    del self._images[key]
+                else:
+                    sizes[key] = len(future.result())
+        nbytes = sum(sizes.values())
+        # least recently used first, skipping images still needed and images being encoded
+        for key in list(self._images):
+            if nbytes <= self.max_bytes:
+                break
+            if key in sizes and self._uses[key] <= 0:
+                del self._images[key]
+                nbytes -= sizes[key]
+
+    def plan(self, images):
+        """Prepare for the (path, mime type) pairs in images to be used in that order, and start encoding
+        the first of them. Images that cannot be found are skipped (and reported by :py:meth:`get`)."""
+        upcoming = []
+        for path, mtype in images:
+            try:
+                upcoming.append((self._key(path), mtype))
+            except OSError:
+                pass
+        self._upcoming = deque(upcoming)
+        self._uses = Counter(key for key, mtype in self._upcoming)
+        self._prefetch()
+        self._evict()
+
+    def get(self, path, mtype):
+        """Return the data URI of the image path, waiting for it to be encoded if necessary"""
+        key = self._key(path)
+        try:
+            self._upcoming.remove((key, mtype))
+        except ValueError:
+            pass
+        future = self._images.pop(key, None)
+        if future is None:
+            future = self._encode(key[0], mtype)
+        # most recently used last
+        self._images[key] = future
+        self._uses[key] -= 1
+        self._prefetch()
+        try:
+            return future.result()
+        finally:
+            self._evict()
+
+
+class _ImageSources(HTMLParser):
+    """Collect the src attributes of img tags"""
+
+    def __init__(self):
+        self.sources = []
+        super().__init__()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'img':
+            self.sources.extend(val for key, val in attrs if key == 'src')
 
 
 class FlattenImages(HTMLParser):
 
-    def __init__(self, htmldir):
+    def __init__(self, htmldir, out=None, cache=None):
+        """Write the html fed to this parser to the text stream out (default sys.stdout),
+        embedding the images it references (relative to htmldir). If cache (an :py:class:`ImageCache`)
+        is given, images are taken from it, otherwise they are encoded straight into out.
+        The total length of the embedded data URIs is counted in embedded_bytes."""
         self.htmldir = htmldir
+        self.out = sys.stdout if out is None else out
+        self.cache = cache
+        self.embedded_bytes = 0
         super().__init__()
 
     def handle_starttag(self, tag, attrs):
         if tag == 'img':
-            newattrs = []
-            for key, val in attrs:
+            self.out.write(f'<{tag} ')
+            for i, (key, val) in enumerate(attrs):
+                if i:
+                    self.out.write(' ')
                 if key == 'src':
-                    if val[-4:] != '.png':
-                        raise RuntimeError('Only png supported. {}'.format(val))
-                    with open(Path(self.htmldir, val), 'rb') as f:
-                        imgdata = base64.b64encode(f.read()).decode()
-                    val = f'data:image/png;base64,{imgdata}'
-                newattrs.append((key, val))
-            print(f'<{tag} ' + ' '.join((f'{key}="{val}"' for key, val in newattrs)) + '>', end='')
+                    mtype = mime_type(val)
+                    if self.cache is None:
+                        prefix = f'data:{mtype};base64,'
+                        self.out.write(f'{key}="{prefix}')
+                        self.embedded_bytes += len(prefix) + write_base64(Path(self.htmldir, val), self.out)
+                        self.out.write('"')
+                    else:
+                        uri = self.cache.get(Path(self.htmldir, val), mtype)
+                        self.out.write(f'{key}="{uri}"')
+                        self.embedded_bytes += len(uri)
+                else:
+                    self.out.write(f'{key}="{val}"')
+            self.out.write('>')
         else:
-            print(self.get_starttag_text(), end='')
+            self.out.write(self.get_starttag_text())
 
     def handle_endtag(self, tag):
-        print(f'</{tag}>', end='')
+        self.out.write(f'</{tag}>')
 
     def handle_data(self, data):
-        print(data, end='')
+        self.out.write(data)
 
     def handle_comment(self, data):
-        print(f'<!--{data}-->', end='')
+        self.out.write(f'<!--{data}-->')
 
     def handle_decl(self, decl):
-        print(f'<!{decl}>')
+        self.out.write(f'<!{decl}>\n')
 
     def handle_pi(self, data):
-        print(f'<?{data}>')
+        self.out.write(f'<?{data}>\n')
 
 
 def get_parser():
     parser = argparse.ArgumentParser(description="""
-Convert an html file with dependent png images into a flat file (i.e., embed those images into the html file). Currently only
-png images are supported, and any other image format will cause an error.
+Convert an html file with dependent images into a flat file (i.e., embed those images into the html file).
+png, jpg, gif, and svg images are supported, and any other image format will cause an error.
 
 .. code-block:: bash
 
    flattenhtml input.html > output.html
+   flattenhtml input.html -o output.html
+
+Many reports can be flattened at once with --batch, for example
+
+.. code-block:: bash
+
+   flattenhtml --batch qc_reports/ extra.html --output_dir flat/ --nprocs 8
 
 """)
-    parser.add_argument('input_file', type=str, help='Input html file.')
+    parser.add_argument('input_file', type=str, nargs='?', help='Input html file. Omit if --batch is used.')
+    parser.add_argument('-o', '--output', type=str, help='Output html file (default standard output).')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Read and encode the images in this many threads, while the html is parsed. Each image '
+                             'is encoded once, however many times it is used. Up to twice this many upcoming '
+                             'images, the images that are used again later in the file, and up to --cache_mb of '
+                             'other encoded images are held in memory. '
+                             'With 0, each image is encoded straight into the output where it is used, without '
+                             'keeping it in memory.')
+    parser.add_argument('--batch', type=str, nargs='+',
+                        help='Flatten these html files, and all .html files in these directories (recursively). '
+                             'Reports in the same directory share an image cache, and different directories are '
+                             'flattened in parallel. A summary of the bytes embedded and time taken for each report '
+                             'is printed, and failures are reported without stopping the other reports.')
+    parser.add_argument('--output_dir', type=str,
+                        help='Write --batch outputs to this directory (keeping the paths of the reports relative '
+                             'to the directories they were found in). By default, outputs are written next to '
+                             'their inputs.')
+    parser.add_argument('--suffix', type=str, default='_flat',
+                        help='Added to the names of the --batch outputs, before .html. Files in --batch '
+                             'directories ending with this suffix are skipped.')
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='Number of worker processes used with --batch')
+    parser.add_argument('--cache_mb', type=int, default=CACHE_BYTES // 2 ** 20,
+                        help='Keep up to this many megabytes of encoded images (dropping the least recently used '
+                             'first) for reuse, including by later reports in the same --batch directory')
     return parser
 
 
-def main():
-    args = get_parser().parse_args()
-    htmldir = Path(args.input_file).parent
-    htmlparser = FlattenImages(htmldir)
-    with open(args.input_file, 'r') as f:
+def flatten(input_file, out, cache=None):
+    """Flatten the html file input_file, writing the result to the text stream out, and return
+    the number of bytes of images embedded. If cache (an :py:class:`ImageCache`) is given, the
+    images are first listed (in a separate pass over the file) and planned in it."""
+    htmldir = Path(input_file).parent
+    if cache is not None:
+        sources = _ImageSources()
+        with open(input_file, 'r') as f:
+            for l in f:
+                sources.feed(l)
+        sources.close()
+        images = []
+        for src in sources.sources:
+            try:
+                images.append((Path(htmldir, src), mime_type(src)))
+            except RuntimeError:
+                # reported when the image is written
+                pass
+        cache.plan(images)
+    htmlparser = FlattenImages(htmldir, out=out, cache=cache)
+    with open(input_file, 'r') as f:
         for l in f:
             htmlparser.feed(l)
+    htmlparser.close()
+    return htmlparser.embedded_bytes
+
+
+def flatten_file(input_file, output_file, cache=None):
+    """Flatten the html file input_file to output_file (creating its directory if necessary) with
+    :py:func:`flatten`, and return the number of bytes of images embedded. output_file is removed on failure."""
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    try:
+        with open(output_file, 'w', buffering=BUFFER_SIZE) as out:
+            return flatten(input_file, out, cache=cache)
+    except BaseException:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+
+
+def batch_pairs(inputs, output_dir=None, suffix='_flat'):
+    """Return a list of (input file, output file) for each html file in inputs. Directories in inputs are
+    replaced by the .html files they contain (recursively, skipping files whose names end in suffix).
+    Output files are named like their inputs with suffix added, and are written to output_dir (keeping their
+    paths relative to the directories they were found in) or, if output_dir is None, next to their inputs.
+    Raises a ValueError if an output file would be the same as its input."""
+    pairs = []
+    for input_ in inputs:
+        input_ = Path(input_)
+        if input_.is_dir():
+            files = [f for f in sorted(input_.rglob('*.html')) if not (suffix and f.stem.endswith(suffix))]
+            relative = [f.relative_to(input_) for f in files]
+        else:
+            files = [input_]
+            relative = [Path(input_.name)]
+        for input_file, rel in zip(files, relative):
+            outdir = input_file.parent if output_dir is None else Path(output_dir, rel.parent)
+            output_file = outdir / (input_file.stem + suffix + input_file.suffix)
+            if output_file.resolve() == input_file.resolve():
+                raise ValueError(f'{input_file} would be overwritten by its output (use --suffix or --output_dir)')
+            pairs.append((str(input_file), str(output_file)))
+    return pairs
+
+
+def _flatten_group(pairs, threads=1, cache_bytes=CACHE_BYTES):
+    """Flatten each (input file, output file) in pairs, sharing one image cache of at most cache_bytes. Returns
+    a list of (input file, output file, bytes embedded, seconds, error message)"""
+    results = []
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        cache = ImageCache(executor, window=2 * threads, max_bytes=cache_bytes) if threads > 0 else None
+        for input_file, output_file in pairs:
+            start = time.perf_counter()
+            nbytes, message = try_call(flatten_file, input_file, output_file, cache=cache)
+            seconds = None if message is not None else time.perf_counter() - start
+            results.append((input_file, output_file, nbytes, seconds, message))
+    return results
+
+
+def flatten_many(pairs, nprocs=1, threads=1, cache_bytes=CACHE_BYTES):
+    """Flatten each (input file, output file) in pairs. Reports in the same directory are flattened in one
+    process sharing an image cache (of at most cache_bytes), and directories are flattened in up to
+    nprocs processes. Returns a list of (input file, output file, bytes embedded, seconds, error message),
+    where error message is None if there was no error."""
+    groups = OrderedDict()
+    for input_file, output_file in pairs:
+        groups.setdefault(os.path.dirname(os.path.abspath(input_file)), []).append((input_file, output_file))
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        results = executor.map(partial(_flatten_group, threads=threads, cache_bytes=cache_bytes), groups.values())
+        return [result for group in results for result in group]
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.batch:
+        if args.input_file is not None or args.output is not None:
+            parser.error('input_file and --output may not be used with --batch')
+        try:
+            pairs = batch_pairs(args.batch, args.output_dir, args.suffix)
+        except ValueError as e:
+            parser.error(str(e))
+        same = duplicates(output_file for input_file, output_file in pairs)
+        if same:
+            parser.error('--batch reports would be flattened to the same outputs: ' + ', '.join(sorted(set(same))))
+        results = flatten_many(pairs, nprocs=args.nprocs, threads=args.threads, cache_bytes=args.cache_mb * 2 ** 20)
+        print('report\tbytes_embedded\tseconds')
+        for input_file, output_file, nbytes, seconds, error in results:
+            if error is None:
+                print(f'{output_file}\t{nbytes}\t{seconds:.3f}')
+            else:
+                print(f'{input_file}: {error}', file=sys.stderr)
+        ok = [result for result in results if result[4] is None]
+        print(f'total\t{sum(r[2] for r in ok)}\t{sum(r[3] for r in ok):.3f}')
+        return 1 if len(ok) < len(results) else 0
+    if args.input_file is None:
+        parser.error('input_file is required unless --batch is used')
+    with ThreadPoolExecutor(max_workers=max(args.threads, 1)) as executor:
+        cache = None
+        if args.threads > 0:
+            cache = ImageCache(executor, window=2 * args.threads, max_bytes=args.cache_mb * 2 ** 20)
+        if args.output is None:
+            flatten(args.input_file, sys.stdout, cache=cache)
+            return
+        # the output is streamed, so a failure would otherwise leave a partial file
+        flatten_file(args.input_file, args.output, cache=cache)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
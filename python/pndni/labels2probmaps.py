@@ -1,8 +1,11 @@
 #!/bin/env python
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import nibabel
 import numpy as np
-from .utils import safeintload, copy_forms
+import os
+from .utils import safeintload, copy_forms, save_image, add_save_arguments, split_ext
 
 
 # from BEP011 (https://docs.google.com/document/d/1YG2g4UkEio4t_STIBOqYOwneLEs1emHIXbGKynx7V0Y/edit#heading=h.mqkmyp254xh6)
@@ -25,27 +28,156 @@ def _get_bids_label(l):
     if l >= len(BIDS_LABELS):
         raise ValueError('label is larger than bids label list')
     return BIDS_LABELS[l][1]
+
+
+def _get_key(l, bids_labels):
+    if bids_labels:
+        return _get_bids_label(l)
+    return l
     
 
-def calc_probmaps(input_files, labels=None, bids_labels=False):
-    probmaps = {}
+def add_counts(counts, x, labels):
+    """Add one to counts[i] wherever x == labels[i], in one pass over x.
+    counts is an integer array of shape (len(labels),) + x.shape. A voxel has only one
+    label, so each voxel of counts is incremented at most once."""
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    pos = np.searchsorted(sorted_labels, x.ravel())
+    np.clip(pos, 0, len(labels) - 1, out=pos)
+    voxels = np.flatnonzero(sorted_labels[pos] == x.ravel())
+    flat = order[pos[voxels]] * x.size
+    flat += voxels
+    counts.reshape(-1)[flat] += 1
+
+
+def count_labels(input_files, labels=None, nprocs=1, checkpoint=None, checkpoint_every=100):
+    """Count the number of input files with each label at each voxel. If labels is not
+    specified, use the labels in the first file. Returns the labels and an array of counts
+    of shape (len(labels),) + image shape, using the smallest unsigned integer type possible.
+
+    If nprocs > 1, the input files are split between nprocs worker processes, each of which
+    counts its own files, and the partial counts are summed.
+
+    If checkpoint is a filename, the counts are saved to it every checkpoint_every files.
+    If it already exists, counting resumes after the last file saved in it.
+    """
+    input_files = list(input_files)
+    counts = None
+    ndone = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        labels, counts, ndone = _load_checkpoint(checkpoint, input_files, labels)
+        # the checkpoint may have been made from fewer files, so its counts may need a wider type
+        counts = counts.astype(np.promote_types(counts.dtype, np.min_scalar_type(len(input_files))))
+    batch_size = checkpoint_every if checkpoint is not None else len(input_files)
+    for start in range(ndone, len(input_files), batch_size):
+        batch = input_files[start:start + batch_size]
+        labels, batch_counts = _count_batch(batch, labels=labels, nprocs=nprocs)
+        if counts is None:
+            counts = batch_counts.astype(np.min_scalar_type(len(input_files)))
+        else:
+            _check_shape(counts, batch_counts.shape[1:], f'input files {start} to {start + len(batch) - 1}')
+            counts += batch_counts
+        if checkpoint is not None:
+            _save_checkpoint(checkpoint, input_files[:start + len(batch)], labels, counts)
+    return labels, counts
+
+
+def _save_checkpoint(checkpoint, done_files, labels, counts):
+    # write to a temporary file first so an interruption does not corrupt the checkpoint
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, files=np.array(done_files, dtype=str), labels=np.asarray(labels), counts=counts)
+    os.replace(tmp, checkpoint)
+
+
+def _load_checkpoint(checkpoint, input_files, labels):
+    with np.load(checkpoint) as f:
+        done_files = list(f['files'])
+        saved_labels = f['labels']
+        counts = f['counts']
+    if done_files != input_files[:len(done_files)]:
+        raise RuntimeError(f'Checkpoint {checkpoint} was created with different input files')
+    if labels is not None and len(labels) > 0 and not np.array_equal(labels, saved_labels):
+        raise RuntimeError(f'Checkpoint {checkpoint} was created with different labels')
+    return saved_labels, counts, len(done_files)
+
+
+def _count_batch(input_files, labels=None, nprocs=1):
+    if nprocs is None or nprocs > 1:
+        if labels is None or len(labels) == 0:
+            labels = np.unique(safeintload(input_files[0]))
+        nshards = min(nprocs or os.cpu_count() or 1, len(input_files))
+        shards = [input_files[i::nshards] for i in range(nshards)]
+        counts = None
+        with ProcessPoolExecutor(max_workers=nshards) as executor:
+            for shard_labels, shard_counts in executor.map(partial(_count_labels, labels=labels), shards):
+                if counts is None:
+                    counts = shard_counts.astype(np.min_scalar_type(len(input_files)))
+                else:
+                    _check_shape(counts, shard_counts.shape[1:], 'a shard of the input files')
+                    counts += shard_counts
+        return labels, counts
+    return _count_labels(input_files, labels=labels)
+
+
+def _check_shape(counts, shape, name):
+    if tuple(shape) != counts.shape[1:]:
+        raise ValueError(f'{name} has shape {tuple(shape)}, but the counts have shape {counts.shape[1:]}')
+
+
+def _count_labels(input_files, labels=None):
+    counts = None
     for file_ in input_files:
         x = safeintload(file_)
         if labels is None or len(labels) == 0:
             labels = np.unique(x)
-        for l in labels:
-            labelmask = (x == l).astype(np.double)
-            if bids_labels:
-                key = _get_bids_label(l)
-            else:
-                key = l
-            if key in probmaps.keys():
-                probmaps[key] += labelmask
-            else:
-                probmaps[key] = labelmask
-    for mask in probmaps.values():
+        if counts is None:
+            counts = np.zeros((len(labels),) + x.shape, dtype=np.min_scalar_type(len(input_files)))
+        _check_shape(counts, x.shape, file_)
+        if len(labels):
+            add_counts(counts, x, labels)
+    return labels, counts
+
+
+def iter_probmaps(input_files, labels=None, bids_labels=False, dtype=np.double, **kwargs):
+    """Yield (label, probability map) for each label, creating only one probability
+    map (of type dtype) at a time from the label counts. kwargs are passed to :py:func:`count_labels`."""
+    labels, counts = count_labels(input_files, labels=labels, **kwargs)
+    for l, count in zip(labels, counts):
+        mask = count.astype(dtype)
         mask /= len(input_files)
-    return probmaps
+        yield _get_key(l, bids_labels), mask
+
+
+def calc_probmaps(input_files, labels=None, bids_labels=False, dtype=np.double, **kwargs):
+    return dict(iter_probmaps(input_files, labels=labels, bids_labels=bids_labels, dtype=dtype, **kwargs))
+
+
+def _sidecar_name(filename):
+    return split_ext(filename, ['.nii.gz', '.nii', '.gz'])[0] + '.tsv'
+
+
+def calc_probmaps_4d(input_files, labels=None, bids_labels=False, dtype=np.double, **kwargs):
+    """Calculate the probability maps as one array with the label as the last axis.
+    Returns the labels and the array. kwargs are passed to :py:func:`count_labels`."""
+    labels, counts = count_labels(input_files, labels=labels, **kwargs)
+    keys = [_get_key(l, bids_labels) for l in labels]
+    out = np.moveaxis(counts, 0, -1).astype(dtype)
+    out /= len(input_files)
+    return keys, out
+
+
+def write_probmaps_4d(outfile, keys, probmaps, header_template, compresslevel=None, threads=1):
+    """Write the 4D probability maps from :py:func:`calc_probmaps_4d` and write the label of each
+    volume to a TSV file with the same name as outfile, but with a .tsv extension."""
+    outnifti = nibabel.Nifti1Image(probmaps, None)
+    copy_forms(header_template, outnifti)
+    save_image(outnifti, outfile, compresslevel=compresslevel, threads=threads)
+    with open(_sidecar_name(outfile), 'w') as f:
+        f.write('index\tlabel\n')
+        for i, key in enumerate(keys):
+            f.write(f'{i}\t{key}\n')
 
     
 def get_parser():
@@ -64,6 +196,20 @@ def get_parser():
     parser.add_argument('--show_bids_labels', action='store_true',
                         help='show the standard bids labels from '
                              '`BEP011 <https://docs.google.com/document/d/1YG2g4UkEio4t_STIBOqYOwneLEs1emHIXbGKynx7V0Y>`_. ')
+    parser.add_argument('--float32', action='store_true',
+                        help='Write single precision probability maps (default double precision)')
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='Split the input files between this many worker processes')
+    parser.add_argument('--single_file', action='store_true',
+                        help='Write all probability maps to one 4D image named out_template (which then does '
+                             'not need to contain "{label}"), and write the label of each volume to a TSV '
+                             'file with the same name and a .tsv extension.')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Save the running counts to this file every --checkpoint_every input files. '
+                             'If the file exists, resume from it (the input files must be listed in the same order).')
+    parser.add_argument('--checkpoint_every', type=int, default=100,
+                        help='Number of input files between checkpoints')
+    add_save_arguments(parser)
     return parser
 
 
@@ -72,13 +218,21 @@ def main():
     if args.show_bids_labels:
         for i, (fullname, abbr) in enumerate(BIDS_LABELS):
             print(f'{i}\t{fullname}\t{abbr}')
-    probmaps = calc_probmaps(args.input_file, labels=args.labels, bids_labels=args.bids_labels)
+    dtype = np.float32 if args.float32 else np.double
+    kwargs = dict(labels=args.labels, bids_labels=args.bids_labels, dtype=dtype, nprocs=args.nprocs,
+                  checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every)
     header_template = nibabel.load(args.input_file[0])
-    for key, mask in probmaps.items():
+    save_kwargs = dict(compresslevel=args.compresslevel, threads=args.compress_threads)
+    if args.single_file:
+        keys, probmaps = calc_probmaps_4d(args.input_file, **kwargs)
+        write_probmaps_4d(args.out_template, keys, probmaps, header_template, **save_kwargs)
+        return
+    probmaps = iter_probmaps(args.input_file, **kwargs)
+    for key, mask in probmaps:
         outfile = args.out_template.format(label=key)
         out = nibabel.Nifti1Image(mask, None)
         copy_forms(header_template, out)
-        out.to_filename(outfile)
+        save_image(out, outfile, **save_kwargs)
 
 
 if __name__ == '__main__':
@@ -1,50 +1,151 @@
 #!/bin/env python
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import nibabel
 import numpy as np
 import os
-import subprocess
+from pathlib import Path
 import sys
-import tempfile
+from .utils import (safeint, slabs, store_slab, split_ext, try_call, duplicates, CHUNK_SIZE, save_image,
+                    add_save_arguments)
+
+
+def minc2labels(input_file, tol=0.1, chunk_size=CHUNK_SIZE):
+    """Read a MINC1 or MINC2 label file (applying the real range scaling) and return a Nifti1Image
+    containing the values rounded to the nearest integer, in the smallest unsigned integer type that holds them.
+    The data are read and checked in slabs of at most chunk_size voxels along the slowest varying
+    dimension of the file, and each slab is written straight into the output array.
+
+    Raises a ValueError if any value is more than tol from the nearest integer, or is negative.
+    The spatial axes of the output are ordered x, y, z.
+    """
+    img = nibabel.load(input_file)
+    dataobj = img.dataobj
+    out = None
+    maxdiff = 0.0
+    for sl in slabs(dataobj.shape, chunk_size, axis=0):
+        x = np.asarray(dataobj[sl], dtype=np.float64)
+        xr = np.around(x)
+        if x.size:
+            maxdiff = max(maxdiff, np.max(np.abs(x - xr)))
+        if maxdiff > tol:
+            # keep reading to report the largest difference, but stop storing the data
+            out = None
+            continue
+        out = store_slab(out, dataobj.shape, sl, safeint(xr))
+    if maxdiff > tol:
+        raise ValueError(f'input image values not close enough to integers (maximum difference {maxdiff})')
+    if out is None:
+        out = np.zeros(dataobj.shape, np.uint8)
+    affine = img.affine
+    if out.ndim == 3:
+        # MINC files are usually stored z, y, x
+        order = list(np.argsort(np.argmax(np.abs(affine[:3, :3]), axis=0)))
+        out = out.transpose(order)
+        affine = affine[:, order + [3]]
+    return nibabel.Nifti1Image(out, affine)
+
+
+def convert_file(input_file, output_file, compresslevel=None, threads=1):
+    """Convert one MINC label file with :py:func:`minc2labels` and save it to output_file"""
+    save_image(minc2labels(input_file), output_file, compresslevel=compresslevel, threads=threads)
+
+
+def _up_to_date(input_file, output_file):
+    return os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(input_file)
+
+
+def batch_pairs(inputs, output_dir, ext='.nii.gz'):
+    """Return a list of (input file, output file) for each MINC file in inputs. Directories in inputs are
+    replaced by the .mnc files they contain. Output files are in output_dir, named like the input with
+    .mnc replaced by ext."""
+    pairs = []
+    for input_ in inputs:
+        input_ = Path(input_)
+        files = sorted(input_.glob('*.mnc')) if input_.is_dir() else [input_]
+        for input_file in files:
+            pairs.append((str(input_file), os.path.join(output_dir, split_ext(input_file.name, ['.mnc'])[0] + ext)))
+    return pairs
+
+
+def convert_many(pairs, nprocs=1, force=False, **kwargs):
+    """Convert each (input file, output file) in pairs using up to nprocs worker processes. Outputs newer than
+    their inputs are skipped unless force is True. A failure is recorded and does not stop the other conversions.
+
+    Returns a list of (input file, output file, status, message), where status is "converted", "skipped",
+    or "failed" (and message is the error for failures, or None)."""
+    results = [None] * len(pairs)
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        futures = {}
+        for i, (input_file, output_file) in enumerate(pairs):
+            if not force and _up_to_date(input_file, output_file):
+                results[i] = (input_file, output_file, 'skipped', None)
+            else:
+                futures[i] = executor.submit(try_call, convert_file, input_file, output_file, **kwargs)
+        for i, future in futures.items():
+            message = future.result()[1]
+            results[i] = pairs[i] + ('converted' if message is None else 'failed', message)
+    return results
 
 
-def _copy_forms(tmp, out):
-    aff, code = tmp.get_qform(coded=True)
-    out.set_qform(aff, code=code)
-    aff, code = tmp.get_sform(coded=True)
-    out.set_sform(aff, code=code)
 def get_parser():
     parser = argparse.ArgumentParser(description="""
-Converts a minc file to a nifti file using ``mnc2nii``, then rounds all the data 
-to the nearest integer and converts the nifti file to an unsigned integer type. Checks that
+Converts a minc (MINC1 or MINC2) file to a nifti file, rounding all the data
+to the nearest integer and converting to an unsigned integer type. Checks that
 all the values are within 0.1 of the nearest integer.
+
+Many files can be converted at once with --inputs and --output_dir, for example
+
+.. code-block:: bash
+
+   mnclabel2niilabel --inputs labels_dir/ extra.mnc --output_dir nifti_labels/ --nprocs 4
+
 """)
-    parser.add_argument('input_file', type=str)
-    parser.add_argument('output_file', type=str)
+    parser.add_argument('input_file', type=str, nargs='?', help='Input file. Omit if --inputs is used.')
+    parser.add_argument('output_file', type=str, nargs='?', help='Output file. Omit if --inputs is used.')
+    parser.add_argument('--inputs', type=str, nargs='+',
+                        help='Convert these files, and all .mnc files in these directories, to --output_dir. '
+                             'Outputs newer than their inputs are skipped (unless --force is used), and failures '
+                             'are reported without stopping the other conversions.')
+    parser.add_argument('--output_dir', type=str, help='Output directory used with --inputs')
+    parser.add_argument('--ext', type=str, default='.nii.gz',
+                        help='Output file extension used with --inputs')
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='Number of worker processes used with --inputs')
+    parser.add_argument('--force', action='store_true',
+                        help='Convert all --inputs, even if the output is newer than the input')
+    add_save_arguments(parser)
     return parser
 
 
 def main():
-    args = get_parser().parse_args()
-    input_file = args.input_file
-    output_file = args.output_file
-    (tmpfd, tmp) = tempfile.mkstemp(suffix='.nii', prefix='mnclabel2niilabel')
-    os.close(tmpfd)
+    parser = get_parser()
+    args = parser.parse_args()
+    save_kwargs = dict(compresslevel=args.compresslevel, threads=args.compress_threads)
+    if args.inputs:
+        if args.input_file is not None or args.output_dir is None:
+            parser.error('--inputs requires --output_dir, and input_file and output_file may not be used')
+        pairs = batch_pairs(args.inputs, args.output_dir, ext=args.ext)
+        same = duplicates(output_file for input_file, output_file in pairs)
+        if same:
+            parser.error('--inputs would be converted to the same outputs: ' + ', '.join(sorted(set(same))))
+        os.makedirs(args.output_dir, exist_ok=True)
+        results = convert_many(pairs, nprocs=args.nprocs, force=args.force, **save_kwargs)
+        for input_file, output_file, status, message in results:
+            if status == 'failed':
+                print(f'{input_file}: {message}', file=sys.stderr)
+        counts = {status: sum(r[2] == status for r in results) for status in ['converted', 'skipped', 'failed']}
+        print('{converted} converted, {skipped} skipped, {failed} failed'.format(**counts))
+        return 1 if counts['failed'] else 0
+    if args.output_file is None:
+        parser.error('input_file and output_file are required unless --inputs is used')
     try:
-        subprocess.check_call(['mnc2nii', input_file, tmp])
-        x = nibabel.load(tmp)
-        xf = x.get_fdata()
-        xfr = np.around(xf)
-        if np.any(np.abs(xf - xfr) > 1e-1):
-            print(np.max(np.abs(xf - xfr)))
-            print('input image values not close enough to integers. exiting')
-            return 1
-        outtype = np.min_scalar_type(int(np.max(xfr)))
-        niout = nibabel.Nifti1Image(xfr.astype(outtype), None)
-        _copy_forms(x, niout)
-        niout.to_filename(output_file)
-    finally:
-        os.remove(tmp)
+        niout = minc2labels(args.input_file)
+    except ValueError as e:
+        print(e)
+        print('exiting')
+        return 1
+    save_image(niout, args.output_file, **save_kwargs)
     return 0
 
 
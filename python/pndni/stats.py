@@ -1,9 +1,14 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from glob import glob
+import sys
 import nibabel
 import numpy as np
-from scipy.ndimage import labeled_comprehension
+import pandas as pd
+from pathlib import Path
 from scipy.stats import skew, kurtosis
+from .utils import split_ext
 
 
 def std(x):
@@ -14,36 +19,242 @@ def std(x):
         return np.std(x, ddof=1)
 
 
+# module level functions (not partials), so they are still found in _GROUPED after being pickled for batch mode
+def _skew(x):
+    return skew(x, axis=None)
+
+
+def _kurtosis(x):
+    return kurtosis(x, axis=None)
+
+
+class LabelGroups(object):
+    """Per-label reductions of an image over an integer label mask.
+
+    The mask is scanned once. Counts, sums and central moment sums are computed
+    for every label with :py:func:`numpy.bincount`, and the values are sorted by
+    label (then by value) only if a median is requested. Labels with no voxels
+    get 0.0, like :py:func:`scipy.ndimage.labeled_comprehension` with a default of 0.0,
+    and labels containing nan get nan, like the numpy and scipy functions.
+    """
+
+    def __init__(self, input, mask, nlabels):
+        sel = mask > 0
+        self.values = np.asarray(input, dtype=np.double)[sel]
+        self.labels = mask[sel]
+        self.nlabels = nlabels
+        self.counts = np.bincount(self.labels, minlength=nlabels + 1)[1:nlabels + 1]
+        self.has_nan = self._bincount(np.isnan(self.values)) > 0
+        self._mean = None
+        self._moments = {}
+        self._sorted = None
+
+    def _bincount(self, weights):
+        return np.bincount(self.labels, weights=weights, minlength=self.nlabels + 1)[1:self.nlabels + 1]
+
+    def _divide(self, num, den):
+        out = np.zeros(self.nlabels)
+        np.divide(num, den, out=out, where=den > 0)
+        return out
+
+    def mean(self):
+        if self._mean is None:
+            self._mean = self._divide(self._bincount(self.values), self.counts)
+        return self._mean
+
+    def moment(self, order):
+        """Sum of (x - mean) ** order for each label"""
+        if order not in self._moments:
+            mean = np.concatenate([[0.0], self.mean()])
+            dev = self.values - mean[self.labels]
+            self._moments[order] = self._bincount(dev ** order)
+        return self._moments[order]
+
+    def segments(self):
+        """Values sorted by label then value, and the start index of each label"""
+        if self._sorted is None:
+            order = np.lexsort((self.values, self.labels))
+            starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+            self._sorted = (self.values[order], starts)
+        return self._sorted
+
+    def segment(self, label_index):
+        values, starts = self.segments()
+        start = starts[label_index]
+        return values[start:start + self.counts[label_index]]
+
+    def std(self):
+        return np.sqrt(self._divide(self.moment(2), self.counts - 1))
+
+    def _constant(self):
+        """True for labels whose minimum and maximum values are equal"""
+        values, starts = self.segments()
+        n = self.counts
+        out = np.zeros(self.nlabels, dtype=bool)
+        valid = n > 0
+        out[valid] = values[starts[valid]] == values[starts[valid] + n[valid] - 1]
+        return out
+
+    def _degenerate(self):
+        # labels where scipy's skew/kurtosis have special handling (too few voxels
+        # or (nearly) constant data); these are passed to the original function.
+        # the tolerance uses the bincount mean, which may be too inexact to catch
+        # exactly constant labels, so those are found from their range
+        m2 = self.moment(2)
+        n = self.counts
+        tol = (np.finfo(np.double).resolution * np.abs(self.mean())) ** 2
+        nearly_constant = (n < 2) | (self._divide(m2, n) <= tol) | self._constant()
+        return (n > 0) & ~self.has_nan & nearly_constant
+
+    def _standardized_moment(self, order, func, offset=0.0):
+        n = self.counts
+        m2 = self._divide(self.moment(2), n)
+        mk = self._divide(self.moment(order), n)
+        out = np.zeros(self.nlabels)
+        valid = (n > 0) & (m2 > 0)
+        out[valid] = mk[valid] / m2[valid] ** (order / 2.0) - offset
+        for i in np.flatnonzero(self._degenerate()):
+            out[i] = func(self.segment(i))
+        out[self.has_nan] = np.nan
+        return out
+
+    def skew(self):
+        return self._standardized_moment(3, _skew)
+
+    def kurtosis(self):
+        # fisher's definition, as in scipy.stats.kurtosis
+        return self._standardized_moment(4, _kurtosis, offset=3.0)
+
+    def median(self):
+        values, starts = self.segments()
+        n = self.counts
+        out = np.zeros(self.nlabels)
+        valid = n > 0
+        lo = starts[valid] + (n[valid] - 1) // 2
+        hi = starts[valid] + n[valid] // 2
+        out[valid] = (values[lo] + values[hi]) / 2.0
+        # lexsort puts nan last, so the middle values may be finite
+        out[self.has_nan] = np.nan
+        return out
+
+    def apply(self, func):
+        """Apply func to every label, using a vectorized version if one is known"""
+        method = _GROUPED.get(func)
+        if method is not None:
+            return method(self)
+        return np.array([func(self.segment(i)) if self.counts[i] > 0 else 0.0
+                         for i in range(self.nlabels)])
+
+
+_GROUPED = {np.mean: LabelGroups.mean,
+            std: LabelGroups.std,
+            _skew: LabelGroups.skew,
+            _kurtosis: LabelGroups.kurtosis,
+            np.median: LabelGroups.median}
+
+
 class Append(argparse.Action):
 
-    def __init__(self, option_strings, dest, nargs=0, function=None, **kwargs):
+    def __init__(self, option_strings, dest, nargs=0, function=None, name=None, **kwargs):
         if nargs != 0:
             raise ValueError('nargs must be 0 for Append action')
         if function is None:
             raise ValueError('function must be specified')
         self.function = function
+        self.name = dest if name is None else name
         super().__init__(option_strings, dest, nargs=nargs, **kwargs)
 
     def __call__(self, parser, namespace, values, option_string):
         if not hasattr(namespace, 'statslist'):
             setattr(namespace, 'statslist', [])
+            setattr(namespace, 'statsnames', [])
         namespace.statslist.append(self.function)
+        namespace.statsnames.append(self.name)
 
 
 def get_parser():
-    parser = argparse.ArgumentParser(description='Behaves like fslstats, but with different statistics.')
-    parser.add_argument('-K', help='Label mask', nargs='?')
-    parser.add_argument('input', help='Input image (nii or nii.gz)')
-    parser.add_argument('-m', help='Mean', action=Append, function=np.mean)
-    parser.add_argument('-s', help='Standard deviation', action=Append, function=std)
-    parser.add_argument('--skew', action=Append, function=partial(skew, axis=None))
-    parser.add_argument('--kurtosis', action=Append, function=partial(kurtosis, axis=None))
+    parser = argparse.ArgumentParser(description='Behaves like fslstats, but with different statistics. '
+                                                 'Use --manifest or --glob to process many images in one call, '
+                                                 'writing a TSV file with subject, label, and statistic columns.')
+    parser.add_argument('-K', help='Label mask. In batch mode, used for any image without its own mask', nargs='?')
+    parser.add_argument('input', help='Input image (nii or nii.gz)', nargs='?')
+    parser.add_argument('-m', help='Mean', action=Append, function=np.mean, name='mean')
+    parser.add_argument('-s', help='Standard deviation', action=Append, function=std, name='std')
+    parser.add_argument('--skew', action=Append, function=_skew)
+    parser.add_argument('--kurtosis', action=Append, function=_kurtosis)
     parser.add_argument('--median', action=Append, function=np.median)
+    batch = parser.add_mutually_exclusive_group()
+    batch.add_argument('--manifest', type=Path,
+                       help='TSV file with an "input" column, and optional "mask" and "subject" columns. '
+                            'Subject defaults to the input file name.')
+    batch.add_argument('--glob', type=str,
+                       help='Glob pattern matching the input images. Subject is the input file name.')
+    parser.add_argument('--output', type=Path,
+                        help='Output TSV file for batch mode (default stdout)')
+    parser.add_argument('--nprocs', type=int,
+                        help='Number of worker processes for batch mode (default number of CPUs)')
     return parser
 
 
+def _subject(input):
+    return split_ext(Path(input).name, ['.nii.gz', '.nii', '.gz'])[0]
+
+
+def read_manifest(manifest, K=None):
+    """Read a batch manifest, returning a list of (subject, input, mask) tuples"""
+    df = pd.read_csv(str(manifest), sep='\t', dtype=str)
+    if 'input' not in df.columns:
+        raise RuntimeError('manifest must have an "input" column')
+    items = []
+    for row in df.itertuples(index=False):
+        row = row._asdict()
+        mask = row.get('mask')
+        if not isinstance(mask, str):
+            mask = K
+        subject = row.get('subject')
+        if not isinstance(subject, str):
+            subject = _subject(row['input'])
+        items.append((subject, row['input'], mask))
+    return items
+
+
+def _stats_item(item, statslist):
+    subject, input, K = item
+    return stats(input, statslist, K=K)
+
+
+def batch_stats(items, statslist, statsnames, nprocs=None):
+    """Run :py:func:`stats` on each (subject, input, mask) tuple in items using a process pool.
+    Returns a DataFrame with one row per subject and label. The label is "n/a" if there is no mask.
+    """
+    items = list(items)
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        results = list(executor.map(partial(_stats_item, statslist=statslist), items))
+    rows = []
+    for (subject, input, K), out in zip(items, results):
+        values = np.reshape(out, (-1, len(statslist)))
+        for i, vals in enumerate(values):
+            rows.append([subject, i + 1 if K else 'n/a'] + list(vals))
+    return pd.DataFrame(rows, columns=['subject', 'label'] + list(statsnames))
+
+
 def main():
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
+    if not hasattr(args, 'statslist'):
+        parser.error('at least one statistic must be specified')
+    if args.manifest or args.glob:
+        if args.input is not None:
+            parser.error('input may not be used with --manifest or --glob')
+        if args.manifest:
+            items = read_manifest(args.manifest, K=args.K)
+        else:
+            items = [(_subject(input), input, args.K) for input in sorted(glob(args.glob))]
+        df = batch_stats(items, args.statslist, args.statsnames, nprocs=args.nprocs)
+        df.to_csv(sys.stdout if args.output is None else args.output, sep='\t', index=False)
+        return
+    if args.input is None:
+        parser.error('input is required unless --manifest or --glob is used')
     out = stats(args.input, args.statslist, K=args.K)
     if out is not None:
         print(' '.join([str(o) for o in out]))
@@ -60,10 +271,10 @@ def stats(input, statslist, K=None):
         if not np.all(uniq == uniq.astype(np.int)):
             raise RuntimeError("mask must have only integer values")
         mask = mask.astype(np.int)
-        labels = np.arange(1, np.max(mask) + 1)
-        out = []
-        for l in labels:
-            out.extend([labeled_comprehension(input, mask, l, func, np.float, 0.0) for func in statslist])
+        groups = LabelGroups(input, mask, max(int(np.max(mask)), 0))
+        # one row per label, one column per statistic
+        columns = [groups.apply(func) for func in statslist]
+        out = [val for row in zip(*columns) for val in row]
     else:
         out = [func(input) for func in statslist]
     return out
@@ -1,7 +1,15 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from functools import partial
+import json
 import nibabel
 import numpy as np
-from .utils import copy_forms
+from .utils import copy_forms, save_image, add_save_arguments, split_ext
+
+
+# largest lookup table used by remap, unless the image is larger
+LUT_MAX = 2 ** 16
 
 
 def parse_mapstr(mapstr):
@@ -14,6 +22,114 @@ def parse_mapstr(mapstr):
     return outmap
 
 
+def read_map_file(map_file):
+    """Read a mapping from a JSON file containing an object of the form {"inval1": outval1, ...}
+    or from a TSV file with two columns (input value and output value) and an optional header."""
+    if str(map_file).endswith('.json'):
+        with open(map_file, 'r') as f:
+            return {int(key): int(val) for key, val in json.load(f).items()}
+    outmap = {}
+    with open(map_file, 'r', newline='') as f:
+        for i, row in enumerate(csv.reader(f, delimiter='\t')):
+            if not row:
+                continue
+            if len(row) != 2:
+                raise ValueError(f'Line {i + 1} of {map_file} must have two columns')
+            try:
+                key, val = int(row[0]), int(row[1])
+            except ValueError:
+                if i == 0:
+                    # header
+                    continue
+                raise
+            outmap[key] = val
+    return outmap
+
+
+class Remapper(object):
+    """Map the values of images with label_map. The sorted keys and values are built once, and
+    lookup tables are built when first needed and reused for every image this object maps
+    (a copy sent to another process starts without them, see :py:func:`swap_files`).
+
+    Unspecified values are set to 0, or kept if keep_unmapped is True. Non-negative integer data are
+    mapped with a dense lookup table if the largest value is small enough, and other data with
+    a sorted table of keys. Either way the data are read in one pass.
+    """
+
+    def __init__(self, label_map, keep_unmapped=False):
+        self.keep_unmapped = keep_unmapped
+        self.outtype = np.min_scalar_type(max(label_map.values()))
+        self.keys = np.array(sorted(label_map.keys()))
+        self.vals = np.array([label_map[k] for k in self.keys], dtype=self.outtype)
+        self._luts = {}
+
+    def _outtype(self, xdata, xmin, xmax):
+        if not self.keep_unmapped:
+            return self.outtype
+        if xdata.dtype.kind in 'ui':
+            return np.result_type(self.outtype, np.min_scalar_type(xmin), np.min_scalar_type(xmax))
+        return np.result_type(self.outtype, xdata.dtype)
+
+    def _lut(self, xmax, outtype):
+        lut = self._luts.get(outtype)
+        if lut is None or len(lut) <= xmax:
+            if self.keep_unmapped:
+                lut = np.arange(xmax + 1).astype(outtype)
+            else:
+                lut = np.zeros(xmax + 1, outtype)
+            inrange = (self.keys >= 0) & (self.keys <= xmax)
+            lut[self.keys[inrange]] = self.vals[inrange]
+            self._luts[outtype] = lut
+        return lut
+
+    def __call__(self, xdata):
+        if xdata.size == 0:
+            return np.zeros(xdata.shape, self.outtype)
+        xmin = xdata.min()
+        xmax = xdata.max()
+        outtype = self._outtype(xdata, xmin, xmax)
+        if xdata.dtype.kind in 'ui' and xmin >= 0:
+            if xmax < max(LUT_MAX, xdata.size):
+                return self._lut(int(xmax), outtype)[xdata]
+        pos = np.searchsorted(self.keys, xdata)
+        np.clip(pos, 0, len(self.keys) - 1, out=pos)
+        found = self.keys[pos] == xdata
+        if self.keep_unmapped:
+            ydata = xdata.astype(outtype)
+        else:
+            ydata = np.zeros(xdata.shape, outtype)
+        ydata[found] = self.vals[pos[found]]
+        return ydata
+
+
+def remap(xdata, label_map, keep_unmapped=False):
+    """Map each value of xdata with label_map. See :py:class:`Remapper`"""
+    return Remapper(label_map, keep_unmapped=keep_unmapped)(xdata)
+
+
+def swap_file(input, output, remapper, compresslevel=None, threads=1):
+    x = nibabel.load(input)
+    xdata = np.asarray(x.dataobj)
+    ydata = remapper(xdata)
+    y = nibabel.Nifti1Image(ydata, None)
+    copy_forms(x, y)
+    save_image(y, output, compresslevel=compresslevel, threads=threads)
+
+
+def swap_files(inputs, outputs, remapper, **kwargs):
+    """Remap each input to the corresponding output with :py:func:`swap_file`, using the same remapper
+    (and therefore the same lookup tables) for all of them"""
+    for input, output in zip(inputs, outputs):
+        swap_file(input, output, remapper, **kwargs)
+
+
+def _output_name(input, suffix):
+    root, ext = split_ext(input, ['.nii.gz', '.nii'])
+    if not ext:
+        raise ValueError(f'{input} is not a nifti file')
+    return root + suffix + ext
+
+
 def get_parser():
     parser = argparse.ArgumentParser(description="""
 Swap/remap labels in an image. For example, to change all the values of 2 in the image to 1 and all the values of 5 to 10
@@ -22,24 +138,60 @@ Swap/remap labels in an image. For example, to change all the values of 2 in the
 
    swaplabels "2: 1, 5: 10" input.nii output.nii
 
-Any unspecified value will be set to 0.
+Any unspecified value will be set to 0 (unless --keep_unmapped is used).
+
+The mapping may also be read from a file, and applied to many images at once. For example
+
+.. code-block:: bash
+
+   swaplabels --map_file map.tsv input.nii output.nii
+   swaplabels --map_file map.json --images sub-*_dseg.nii.gz --nprocs 4
+
 """)
-    parser.add_argument('map', type=str,
+    parser.add_argument('map', type=str, nargs='?',
                         help="Mapping string of the form 'inval1: outval1, inval2: outval2, ...' "
-                        "All values must be integers.")
-    parser.add_argument('input', type=str)
-    parser.add_argument('output', type=str)
+                        "All values must be integers. Omit if --map_file is used.")
+    parser.add_argument('input', type=str, nargs='?', help='Input image. Omit if --images is used.')
+    parser.add_argument('output', type=str, nargs='?', help='Output image. Omit if --images is used.')
+    parser.add_argument('--map_file', type=str,
+                        help='Read the mapping from a JSON file containing an object of the form '
+                             '{"inval1": outval1, ...}, or from a TSV file with two columns (input value '
+                             'and output value) and an optional header row.')
+    parser.add_argument('--images', type=str, nargs='+',
+                        help='Apply the mapping to all these images, writing each output next to its input '
+                             'with --suffix added to the name.')
+    parser.add_argument('--suffix', type=str, default='_swapped',
+                        help='Suffix added to output file names with --images')
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='Number of worker processes used with --images')
+    parser.add_argument('--keep_unmapped', action='store_true',
+                        help='Keep values not in the mapping, instead of setting them to 0.')
+    add_save_arguments(parser)
     return parser
 
 
 def main():
-    args = get_parser().parse_args()
-    label_map = parse_mapstr(args.map)
-    x = nibabel.load(args.input)
-    xdata = np.asarray(x.dataobj)
-    ydata = np.zeros(xdata.shape, np.min_scalar_type(max(label_map.values())))
-    for key, val in label_map.items():
-        ydata[xdata == key] = val
-    y = nibabel.Nifti1Image(ydata, None)
-    copy_forms(x, y)
-    y.to_filename(args.output)
+    parser = get_parser()
+    args = parser.parse_args()
+    positional = [a for a in [args.map, args.input, args.output] if a is not None]
+    if args.map_file is not None:
+        label_map = read_map_file(args.map_file)
+    elif positional:
+        label_map = parse_mapstr(positional.pop(0))
+    else:
+        parser.error('a mapping string or --map_file is required')
+    remapper = Remapper(label_map, keep_unmapped=args.keep_unmapped)
+    save_kwargs = dict(compresslevel=args.compresslevel, threads=args.compress_threads)
+    if args.images:
+        if positional:
+            parser.error('input and output may not be used with --images')
+        outputs = [_output_name(input, args.suffix) for input in args.images]
+        # one shard of images per worker, so each worker builds its lookup tables once
+        nshards = max(1, min(args.nprocs, len(args.images)))
+        shards = [(args.images[i::nshards], outputs[i::nshards]) for i in range(nshards)]
+        with ProcessPoolExecutor(max_workers=nshards) as executor:
+            list(executor.map(partial(swap_files, remapper=remapper, **save_kwargs), *zip(*shards)))
+        return
+    if len(positional) != 2:
+        parser.error('input and output are required unless --images is used')
+    swap_file(positional[0], positional[1], remapper, **save_kwargs)
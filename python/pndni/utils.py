@@ -1,5 +1,17 @@
+from collections import Counter
+import gzip
+import io
+import os
+import shutil
+import subprocess
 import numpy as np
 import nibabel
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.openers import Opener
+
+
+# maximum number of voxels read from an image at once
+CHUNK_SIZE = 2 ** 22
 
 
 def copy_forms(tmp, out):
@@ -9,10 +21,169 @@ def copy_forms(tmp, out):
     out.set_sform(aff, code=code)
 
 
-def safeintload(file_):
-    x = np.asarray(nibabel.load(file_).dataobj)
-    xc = x.astype('uint32', copy=False)
-    if xc is not x:
-        if not np.all(x == xc):
+def slabs(shape, chunk_size=CHUNK_SIZE, axis=None):
+    """Split an array of shape "shape" into slabs of at most chunk_size voxels
+    (but at least one slice) along axis (default the third axis, or the last axis if there are fewer than three).
+    Yields tuples of slices."""
+    if axis is None:
+        axis = min(2, len(shape) - 1)
+    slice_size = int(np.prod(shape[:axis])) * int(np.prod(shape[axis + 1:]))
+    step = max(1, chunk_size // max(1, slice_size))
+    for start in range(0, shape[axis], step):
+        yield (slice(None),) * axis + (slice(start, min(start + step, shape[axis])),)
+
+
+def safeint(x):
+    """Return x as an unsigned integer array, raising a ValueError if it contains non integer values or values < 0.
+    Unsigned arrays are returned unchanged, signed arrays are viewed as the unsigned type of the same size,
+    and other arrays are converted to the smallest unsigned type that holds their values."""
+    if x.dtype.kind == 'u':
+        return x
+    if x.dtype.kind == 'i':
+        if x.size and x.min() < 0:
             raise ValueError('input image contained non integer values or values < 0')
+        return x.view(np.dtype(x.dtype.byteorder + 'u' + str(x.dtype.itemsize)))
+    if x.size == 0:
+        return x.astype(np.uint8)
+    xmin = x.min()
+    xmax = x.max()
+    if not (xmin >= 0 and np.isfinite(xmax)):
+        raise ValueError('input image contained non integer values or values < 0')
+    xc = x.astype(np.min_scalar_type(int(xmax)))
+    if not np.all(x == xc):
+        raise ValueError('input image contained non integer values or values < 0')
     return xc
+
+
+def safeintload(file_, mmap=True, chunk_size=CHUNK_SIZE):
+    """Load an image that must contain only integers >= 0 as an unsigned integer array.
+
+    Integer images are not copied to a wider type: unsigned data are returned as stored (a memory-mapped
+    array for uncompressed files if mmap is True), and signed data are checked and viewed as unsigned.
+    Floating point or scaled data are read, checked, and converted one slab (of at most chunk_size voxels)
+    at a time into the output array, which is widened when a slab needs a larger type, and returned in
+    the smallest unsigned type that holds them.
+    """
+    # keep the file open so compressed images are not decompressed from the start for every slab
+    dataobj = nibabel.load(str(file_), mmap=mmap, keep_file_open=True).dataobj
+    if not isinstance(dataobj, ArrayProxy):
+        return safeint(np.asarray(dataobj))
+    if dataobj.slope == 1 and dataobj.inter == 0 and dataobj.dtype.kind in 'ui':
+        return safeint(dataobj.get_unscaled())
+    out = None
+    for sl in slabs(dataobj.shape, chunk_size):
+        out = store_slab(out, dataobj.shape, sl, safeint(np.asarray(dataobj[sl])))
+    return np.zeros(dataobj.shape, np.uint8) if out is None else out
+
+
+def store_slab(out, shape, sl, part):
+    """Store part in out[sl] and return out. If out is None, it is first allocated with shape and
+    the type of part (at least uint8), and if part does not fit in the type of out, out is
+    converted to a type that holds both (this only copies when the type widens)."""
+    if out is None:
+        out = np.zeros(shape, np.result_type(np.uint8, part.dtype))
+    elif not np.can_cast(part.dtype, out.dtype):
+        out = out.astype(np.result_type(out.dtype, part.dtype))
+    out[sl] = part
+    return out
+
+
+class _PipeWriter:
+    """Write-only file object around a pipe, which tracks its position so nibabel can write an
+    image to it (nibabel only seeks to the position it is already at when writing a single file)."""
+
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+
+    def write(self, b):
+        self.f.write(b)
+        self.pos += len(b)
+        return len(b)
+
+    def read(self, size=-1):
+        raise io.UnsupportedOperation('read')
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        if whence == 2 or offset != self.pos:
+            raise io.UnsupportedOperation('seek')
+        return self.pos
+
+
+def _pigz_command(compresslevel, threads):
+    """Return the command to compress to stdout with pigz, or None if threads < 2 or pigz is not installed"""
+    if threads < 2:
+        return None
+    pigz = shutil.which('pigz')
+    if pigz is None:
+        return None
+    return [pigz, '-c', f'-{compresslevel}', '-p', str(threads)]
+
+
+def save_image(img, filename, compresslevel=None, threads=1):
+    """Save a single file image (e.g. a Nifti1Image). Files ending in .gz are compressed with gzip
+    at compresslevel (0-9, default nibabel's default level). Use a name without .gz to write uncompressed.
+    If threads > 1 and pigz is installed, compress with pigz using that many threads."""
+    filename = str(filename)
+    if not filename.endswith('.gz') or (compresslevel is None and threads < 2):
+        img.to_filename(filename)
+        return
+    if compresslevel is None:
+        compresslevel = Opener.default_compresslevel
+    command = _pigz_command(compresslevel, threads)
+    if command is None:
+        with gzip.open(filename, 'wb', compresslevel=compresslevel) as f:
+            img.to_file_map({'image': nibabel.FileHolder(filename, fileobj=f)})
+        return
+    with open(filename, 'wb') as f:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=f)
+        try:
+            img.to_file_map({'image': nibabel.FileHolder(filename, fileobj=_PipeWriter(proc.stdin))})
+        finally:
+            proc.stdin.close()
+            proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def add_save_arguments(parser):
+    """Add the --compresslevel and --compress_threads options used by :py:func:`save_image` to parser"""
+    parser.add_argument('--compresslevel', type=int, choices=range(10),
+                        help='gzip compression level (0-9) for output files ending in .gz. '
+                             'Name the output .nii to write it uncompressed.')
+    parser.add_argument('--compress_threads', type=int, default=1,
+                        help='Compress .gz output files with this many threads using pigz '
+                             '(if pigz is installed)')
+
+
+def split_ext(filename, exts):
+    """Split filename into (root, ext), where ext is the longest of exts that filename ends with,
+    or '' if it ends with none of them"""
+    filename = str(filename)
+    matches = [ext for ext in exts if ext and filename.endswith(ext)]
+    if not matches:
+        return filename, ''
+    ext = max(matches, key=len)
+    return filename[:-len(ext)], ext
+
+
+def try_call(func, *args, **kwargs):
+    """Return (func(*args, **kwargs), None), or (None, error message) if func raises an exception,
+    so a failure in a batch can be recorded without stopping the other items"""
+    try:
+        return func(*args, **kwargs), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def duplicates(filenames):
+    """Return the file names in filenames that refer to the same file as another entry (compared by
+    absolute path), so batch outputs that would overwrite each other can be reported before any are written"""
+    filenames = list(filenames)
+    counts = Counter(os.path.abspath(filename) for filename in filenames)
+    return [filename for filename in filenames if counts[os.path.abspath(filename)] > 1]
@@ -31,6 +31,7 @@ setup(
             'minc_default_dircos = pndni.minc_default_dircos:main',
             'stats = pndni.stats:main',
             'convertpoints = pndni.convertpoints:main',
+            'landmarkerrors = pndni.convertpoints:errors_main',
             'minc_force_regular_spacing = pndni.minc_force_regular_spacing:main',
         ],
     },
@@ -1,3 +1,6 @@
+import csv
+from pathlib import Path
+import subprocess
 from pndni import all_equal
 import nibabel
 import numpy as np
@@ -11,6 +14,18 @@ def test_simple():
     assert all_equal.compare(x, y, close=True)
 
 
+def test_2d():
+    x = nibabel.Nifti1Image(np.arange(12.0).reshape(3, 4), np.eye(4))
+    y = nibabel.Nifti1Image(np.arange(12.0).reshape(3, 4), np.eye(4))
+    assert all_equal.compare(x, y)
+    assert all_equal.compare(x, y, chunk_size=4)
+    flipped = np.diag([-1.0, 1.0, 1.0, 1.0])
+    flipped[0, 3] = 2.0
+    assert all_equal.compare(x, nibabel.Nifti1Image(np.arange(12.0).reshape(3, 4)[::-1], flipped))
+    z = nibabel.Nifti1Image(np.arange(12.0).reshape(3, 4) + np.eye(3, 4), np.eye(4))
+    assert not all_equal.compare(x, z)
+
+
 def test_offset1():
     xarr = np.arange(24).reshape(2, 3, 4)
     xarr[:1] = 0
@@ -156,3 +171,132 @@ def test_simple_normalize():
         all_equal.compare(xi, y, normalize=True, close=True)
     assert not all_equal.compare(x, y, close=True)
     assert all_equal.compare(x, y, normalize=True, close=True)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 10 ** 6])
+def test_chunked_reoriented(tmp_path, chunk_size):
+    rng = np.random.RandomState(0)
+    xarr = np.zeros((5, 6, 7, 3))
+    xarr[1:, 2:, :-2] = rng.normal(size=(4, 4, 5, 3))
+    x = nibabel.Nifti1Image(xarr, np.diag([2.0, 1.5, 1.0, 1.0]))
+    # flip the first two axes and swap the last two, then crop to the non-zero data
+    y = x.as_reoriented([[0, -1], [1, -1], [2, 1]]).as_reoriented([[0, 1], [2, 1], [1, 1]])
+    y = y.slicer[:4, :5, :4]
+    nibabel.save(x, str(tmp_path / 'x.nii.gz'))
+    nibabel.save(y, str(tmp_path / 'y.nii.gz'))
+    xf = nibabel.load(str(tmp_path / 'x.nii.gz'), keep_file_open=True)
+    yf = nibabel.load(str(tmp_path / 'y.nii.gz'), keep_file_open=True)
+    for im1, im2 in [(x, y), (y, x), (xf, yf), (yf, xf)]:
+        assert isinstance(all_equal.compare(im1, im2, chunk_size=chunk_size), all_equal.Equal)
+        assert all_equal.compare(im1, im2, close=True, normalize=True, chunk_size=chunk_size)
+    xarr2 = xarr.copy()
+    xarr2[0, 3, 3, 1] = 1.0
+    x2 = nibabel.Nifti1Image(xarr2, x.affine)
+    assert isinstance(all_equal.compare(x2, y, chunk_size=chunk_size), all_equal.NotEqual)
+    assert all_equal.compare(x2, y, intersection_only=True, chunk_size=chunk_size)
+    xarr2 = xarr.copy()
+    xarr2[3, 3, 3, 2] += 1.0
+    x2 = nibabel.Nifti1Image(xarr2, x.affine)
+    assert isinstance(all_equal.compare(x2, y, chunk_size=chunk_size), all_equal.NotEqual)
+    assert not all_equal.compare(y, x2, intersection_only=True, chunk_size=chunk_size)
+    assert not all_equal.compare(x, y.slicer[..., :2], chunk_size=chunk_size)
+
+
+def test_byte_check(tmp_path):
+    xarr = np.arange(24).reshape(2, 3, 4).astype(np.int16)
+    x = nibabel.Nifti1Image(xarr, np.eye(4))
+    for name in ['x1.nii', 'x2.nii.gz', 'x3.nii.gz']:
+        nibabel.save(x, str(tmp_path / name))
+    # different scaling, same raw data
+    x.header.set_slope_inter(2.0, 0.0)
+    nibabel.save(x, str(tmp_path / 'x4.nii'))
+    xarr2 = xarr.copy()
+    xarr2[1, 2, 3] = 0
+    nibabel.save(nibabel.Nifti1Image(xarr2, np.eye(4)), str(tmp_path / 'x5.nii.gz'))
+    ims = {name: nibabel.load(str(tmp_path / name)) for name in ['x1.nii', 'x2.nii.gz', 'x3.nii.gz', 'x4.nii', 'x5.nii.gz']}
+    assert all_equal.raw_equal(ims['x1.nii'], ims['x2.nii.gz'])
+    assert all_equal.raw_equal(ims['x2.nii.gz'], ims['x3.nii.gz'])
+    assert not all_equal.raw_equal(ims['x1.nii'], ims['x4.nii'])
+    assert not all_equal.raw_equal(ims['x1.nii'], ims['x5.nii.gz'])
+    assert not all_equal.raw_equal(x, x)
+    res = all_equal.compare(ims['x1.nii'], ims['x2.nii.gz'], byte_check=True)
+    assert res and 'identical raw data' in res.desc
+    res = all_equal.compare(ims['x1.nii'], ims['x4.nii'], byte_check=True)
+    assert not res
+    with pytest.raises(ValueError):
+        # int data may not be normalized, even if identical
+        all_equal.compare(ims['x1.nii'], ims['x2.nii.gz'], byte_check=True, normalize=True, close=True)
+    res = all_equal.compare(ims['x1.nii'], ims['x5.nii.gz'], byte_check=True)
+    assert isinstance(res, all_equal.NotEqual)
+
+
+def test_dirs(tmp_path):
+    xarr = np.arange(24).reshape(2, 3, 4).astype(np.float32)
+    for d in ['a', 'b']:
+        (tmp_path / d / 'sub').mkdir(parents=True)
+        nibabel.save(nibabel.Nifti1Image(xarr, np.eye(4)), str(tmp_path / d / 'x.nii'))
+    nibabel.save(nibabel.Nifti1Image(xarr, np.eye(4)), str(tmp_path / 'a' / 'sub' / 'y.nii.gz'))
+    nibabel.save(nibabel.Nifti1Image(xarr + 1, np.eye(4)), str(tmp_path / 'b' / 'sub' / 'y.nii.gz'))
+    nibabel.save(nibabel.Nifti1Image(xarr, np.eye(4)), str(tmp_path / 'a' / 'sub' / 'z.nii.gz'))
+    (tmp_path / 'a' / 'notes.txt').write_text('ignored')
+    pairs = all_equal.pair_dirs(tmp_path / 'a', tmp_path / 'b')
+    assert [tuple(p and Path(p).relative_to(tmp_path).as_posix() for p in pair) for pair in pairs] == \
+        [('a/sub/y.nii.gz', 'b/sub/y.nii.gz'), ('a/sub/z.nii.gz', None), ('a/x.nii', 'b/x.nii')]
+    results = all_equal.compare_many(pairs, nprocs=2)
+    assert [r.name for r in results] == ['NotEqual', 'Missing', 'Equal']
+    report = tmp_path / 'report.tsv'
+    ret = subprocess.run(['allequal', str(tmp_path / 'a'), str(tmp_path / 'b'), '--report', str(report),
+                          '--nprocs', '2', '--batch_size', '2'])
+    assert ret.returncode == 3
+    with open(report, 'r', newline='') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    assert [row['result'] for row in rows] == ['NotEqual', 'Missing', 'Equal']
+    assert rows[1]['image2'] == 'n/a'
+    with open(tmp_path / 'manifest.tsv', 'w') as f:
+        f.write('image1\timage2\n')
+        f.write('{}\t{}\n'.format(tmp_path / 'a' / 'x.nii', tmp_path / 'b' / 'x.nii'))
+        f.write('{}\t{}\n'.format(tmp_path / 'a' / 'x.nii', tmp_path / 'a' / 'notes.txt'))
+    ret = subprocess.run(['allequal', '--manifest', str(tmp_path / 'manifest.tsv'), '--report', str(report)])
+    assert ret.returncode == 4
+    with open(report, 'r', newline='') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    assert [row['result'] for row in rows] == ['Equal', 'Failed']
+
+
+@pytest.mark.parametrize('chunk_size', [1, 10 ** 6])
+def test_diagnostics(tmp_path, chunk_size):
+    xarr = np.arange(5 * 6 * 7).reshape(5, 6, 7).astype(np.float64)
+    x = nibabel.Nifti1Image(xarr, np.eye(4))
+    yarr = xarr.copy()
+    yarr[1, 2, 3] += 0.3
+    yarr[3, 4, 1] -= 10.0
+    y = nibabel.Nifti1Image(yarr, np.eye(4))
+    # flipped and transposed version of y
+    yr = y.as_reoriented([[2, -1], [0, 1], [1, -1]])
+    for im2 in [y, yr]:
+        res = all_equal.compare(x, im2, diagnostics=True, max_coords=1, chunk_size=chunk_size)
+        assert isinstance(res, all_equal.NotEqual)
+        assert res.diagnostics.count == 2
+        assert res.diagnostics.max_abs == 10.0
+        assert np.isclose(res.diagnostics.max_rel, max(0.3 / (xarr[1, 2, 3] + 0.3), 10.0 / xarr[3, 4, 1]))
+        assert res.diagnostics.bbox() == [(1, 3), (2, 4), (1, 3)]
+        assert len(res.diagnostics.coords) == 1
+        assert res.diagnostics.coords[0][0] in [(1, 2, 3), (3, 4, 1)]
+        res = all_equal.compare(x, im2, diagnostics=True, close=True, chunk_size=chunk_size)
+        assert res.diagnostics.count == 2
+        res = all_equal.compare(x, im2, diagnostics=True, round_=True, chunk_size=chunk_size)
+        assert res.diagnostics.count == 1
+        assert res.diagnostics.bbox() == [(3, 3), (4, 4), (1, 1)]
+    assert all_equal.compare(x, x, diagnostics=True).diagnostics is None
+    nibabel.save(x, str(tmp_path / 'x.nii'))
+    nibabel.save(yr, str(tmp_path / 'y.nii'))
+    ret = subprocess.run(['allequal', str(tmp_path / 'x.nii'), str(tmp_path / 'y.nii'), '--diagnostics',
+                          '--diff_coords', str(tmp_path / 'coords.tsv')], stdout=subprocess.PIPE)
+    assert ret.returncode == 1
+    assert b'2 voxels differ' in ret.stdout
+    with open(tmp_path / 'coords.tsv', 'r', newline='') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    assert sorted((int(r['i']), int(r['j']), int(r['k'])) for r in rows) == [(1, 2, 3), (3, 4, 1)]
+    for r in rows:
+        assert float(r['value1']) == xarr[int(r['i']), int(r['j']), int(r['k'])]
+        assert float(r['value2']) == yarr[int(r['i']), int(r['j']), int(r['k'])]
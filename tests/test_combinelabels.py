@@ -1,15 +1,18 @@
+from functools import reduce
 import subprocess
 import nibabel
 import numpy as np
+import pytest
+from pndni.combinelabels import combine2labels, combine_labels, label_radices, encode_labels, decode_labels
 
 
-def _wrapper(tmpdir, labels):
+def _wrapper(tmpdir, labels, extra_args=()):
     fnames = []
     for i, l in enumerate(labels):
         fnames.append(str(tmpdir / f'l{i}.nii'))
         nibabel.Nifti1Image(np.atleast_3d(l), None).to_filename(fnames[-1])
     outname = str(tmpdir / 'out.nii')
-    subprocess.check_call(['combinelabels', outname] + fnames)
+    subprocess.check_call(['combinelabels', outname] + fnames + list(extra_args))
     out = nibabel.load(outname)
     return np.asarray(out.dataobj).ravel()
 
@@ -60,3 +63,60 @@ def test_combinelabels5(tmpdir):
     out2 = _wrapper(tmpdir, [out, l3])
     assert np.all(out2 == [19, 26, 21, 28, 23, 24])
     assert out2.dtype == 'uint8'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 10 ** 6])
+def test_combine_labels(chunk_size):
+    rng = np.random.RandomState(0)
+    for nimages in [1, 2, 3, 5]:
+        for maxlabel in [1, 3, 300]:
+            labels = [rng.randint(0, maxlabel + 1, size=(3, 4, 5)).astype(np.uint32) for i in range(nimages)]
+            # uint64 so the reference does not overflow
+            truth = reduce(combine2labels, [l.astype(np.uint64) for l in labels])
+            truth = truth.astype(np.min_scalar_type(truth.max()))
+            out = combine_labels(labels, chunk_size=chunk_size)
+            assert out.dtype == truth.dtype
+            assert np.all(out == truth)
+    # the maximum of the first image is not the maximum of the output
+    l1 = np.array([300, 1, 2]).reshape(1, 1, 3)
+    l2 = np.array([0, 2, 1]).reshape(1, 1, 3)
+    truth = combine2labels(l1, l2)
+    out = combine_labels([l1, l2], chunk_size=chunk_size)
+    assert out.dtype == np.uint16
+    assert np.all(out == truth)
+    out = combine_labels([l1, l2, np.array([1, 1, 2]).reshape(1, 1, 3)], chunk_size=chunk_size)
+    assert np.all(out == reduce(combine2labels, [l1, l2, np.array([1, 1, 2]).reshape(1, 1, 3)]))
+    with pytest.raises(ValueError):
+        combine_labels([l1, l2 - 1], chunk_size=chunk_size)
+
+
+def test_decode_labels():
+    rng = np.random.RandomState(1)
+    labels = [rng.randint(0, 6, size=(3, 4, 5)) for i in range(3)]
+    radices = label_radices(labels)
+    out = encode_labels(labels, radices)
+    codes = np.unique(out)
+    codes = codes[codes > 0]
+    tuples = decode_labels(codes, radices)
+    valid = np.all([l > 0 for l in labels], axis=0)
+    for code, t in zip(codes, tuples):
+        assert np.all(np.stack([l[out == code] for l in labels]) == t[:, np.newaxis])
+    assert len(codes) == len(set(map(tuple, np.stack(labels)[:, valid].T)))
+
+
+def test_compact(tmpdir):
+    l1 = np.array([1, 2, 3, 1, 2, 3, 0])
+    l2 = np.array([1, 1, 1, 5, 5, 5, 1])
+    out = _wrapper(tmpdir, [l1, l2])
+    assert np.all(out == [1, 2, 3, 13, 14, 15, 0])
+    out = _wrapper(tmpdir, [l1, l2], ['--compact', '--label_table', str(tmpdir / 'table.tsv')])
+    assert np.all(out == [1, 2, 3, 4, 5, 6, 0])
+    assert out.dtype == 'uint8'
+    with open(tmpdir / 'table.tsv', 'r') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'label\t{}\t{}'.format(tmpdir / 'l0.nii', tmpdir / 'l1.nii')
+    assert lines[1:] == ['1\t1\t1', '2\t2\t1', '3\t3\t1', '4\t1\t5', '5\t2\t5', '6\t3\t5']
+    out = _wrapper(tmpdir, [l1, l2], ['--label_table', str(tmpdir / 'table.tsv')])
+    with open(tmpdir / 'table.tsv', 'r') as f:
+        lines = f.read().splitlines()
+    assert lines[1:] == ['1\t1\t1', '2\t2\t1', '3\t3\t1', '13\t1\t5', '14\t2\t5', '15\t3\t5']
@@ -1,6 +1,11 @@
+import nibabel
+import numpy as np
+import pandas as pd
 import pytest
 import csv
+import json
 from pndni.convertpoints import Points, SinglePoint
+import shutil
 import subprocess
 
 
@@ -71,3 +76,185 @@ def test_convert(points_path):
             outfile = 'out_' + truefile
             subprocess.check_call(['convertpoints', str(points_path / infile), str(points_path / outfile)])
             assert cmp(points_path / outfile, points_path / truefile)
+
+
+@pytest.mark.parametrize('ext', ['.tsv', '.csv', '.tag', '.fcsv', '.npy', '.npz', '.json', '.mrk.json'])
+def test_Points_arrays(tmp_path, ext):
+    rng = np.random.RandomState(0)
+    coords = rng.normal(scale=100.0, size=(1000, 3))
+    index = rng.permutation(1000)
+    p = Points.from_arrays(coords, index)
+    assert len(p) == 1000
+    assert p.points[3] == SinglePoint(*coords[3], index[3])
+    assert Points(p.points) == p
+    p.to_file(tmp_path / ('out' + ext))
+    assert Points.from_file(tmp_path / ('out' + ext)) == p
+    empty = Points([])
+    empty.to_file(tmp_path / ('empty' + ext))
+    assert Points.from_file(tmp_path / ('empty' + ext)) == empty
+
+
+def test_transform_sample(tmp_path):
+    affine = np.array([[2.0, 0.0, 0.0, -10.0],
+                       [0.0, 0.0, 3.0, 5.0],
+                       [0.0, -1.0, 0.0, 7.0],
+                       [0.0, 0.0, 0.0, 1.0]])
+    i, j, k = np.meshgrid(np.arange(5), np.arange(6), np.arange(7), indexing='ij')
+    data = (i + 10 * j + 100 * k).astype(np.int16)
+    nibabel.Nifti1Image(data, affine).to_filename(str(tmp_path / 'img.nii'))
+    ijk = np.array([[1.0, 2.0, 3.0], [1.5, 2.25, 3.0], [4.0, 5.0, 6.0], [3.6, 0.4, 0.0], [-1.0, 0.0, 0.0]])
+    p = Points.from_arrays(ijk, np.arange(5))
+    img = nibabel.load(str(tmp_path / 'img.nii'))
+    world = p.voxel_to_world(img)
+    assert np.allclose(world.coords, ijk @ affine[:3, :3].T + affine[:3, 3])
+    assert np.allclose(world.world_to_voxel(img).coords, ijk)
+    linear = world.sample(img)
+    assert np.allclose(linear[:4], [321.0, 324.0, 654.0, 7.6])
+    assert np.isnan(linear[4])
+    nearest = world.sample(img, interpolation='nearest')
+    assert np.allclose(nearest[:4], [321.0, 322.0, 654.0, 4.0])
+    assert np.isnan(nearest[4])
+
+    world.to_tsv(tmp_path / 'world.tsv')
+    subprocess.check_call(['convertpoints', str(tmp_path / 'world.tsv'), str(tmp_path / 'out.tsv'),
+                           '--sample', str(tmp_path / 'img.nii')])
+    df = pd.read_csv(tmp_path / 'out.tsv', sep='\t')
+    assert list(df.columns) == ['x', 'y', 'z', 'index', 'img']
+    assert np.allclose(df[['x', 'y', 'z']].to_numpy(), world.coords)
+    assert np.allclose(df['img'][:4], linear[:4])
+    assert np.isnan(df['img'][4])
+    proc = subprocess.run(['convertpoints', str(tmp_path / 'world.tsv'), str(tmp_path / 'out.fcsv'),
+                           '--sample', str(tmp_path / 'img.nii')], stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.returncode == 2
+    assert 'only be written to .tsv' in proc.stderr
+    assert not (tmp_path / 'out.fcsv').exists()
+    # in batch mode the image is loaded once and sampled for every file
+    nibabel.Nifti1Image(data, affine).to_filename(str(tmp_path / 'img.nii.gz'))
+    world.to_tsv(tmp_path / 'world2.tsv')
+    subprocess.check_call(['convertpoints', '--batch', str(tmp_path / 'world.tsv'), str(tmp_path / 'world2.tsv'),
+                           '--output_dir', str(tmp_path / 'batch'), '--output_ext', '.tsv',
+                           '--sample', str(tmp_path / 'img.nii.gz')])
+    for name in ['world', 'world2']:
+        df = pd.read_csv(tmp_path / 'batch' / (name + '.tsv'), sep='\t')
+        assert np.allclose(df['img'][:4], linear[:4])
+    np.savetxt(tmp_path / 'affine.txt', affine)
+    for transform in ['affine.txt', 'img.nii']:
+        subprocess.check_call(['convertpoints', str(tmp_path / 'world.tsv'), str(tmp_path / 'out.tsv'),
+                               '--transform', str(tmp_path / transform), '--invert'])
+        assert np.allclose(Points.from_tsv(tmp_path / 'out.tsv').coords, ijk)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 2 ** 20])
+def test_from_minc_tag_variants(tmp_path, chunk_size):
+    expected = Points([SinglePoint(1.1, 1.2, 1.3, 10),
+                       SinglePoint(2.1, 2.2, 2.3, 20),
+                       SinglePoint(-3.0, 0.0, 3.5, 3)])
+    (tmp_path / 'one.tag').write_text("""MNI Tag Point File
+% a comment
+Volumes = 1;
+Points =
+ 1.1 1.2 1.3 "10" # a comment
+ 2.1 2.2 2.3 0 -1 -1 "20"
+ -3 0 3.5
+ 1 -1 -1 "3";
+""")
+    (tmp_path / 'two.tag').write_text("""MNI Tag Point File
+Volumes = 2;
+% Volume 1: a.mnc
+Points =
+ 1.1 1.2 1.3 5 5 5 "10"
+ 2.1 2.2 2.3 6 6 6 0 -1 -1 "20"
+ -3 0 3.5 7 7 7 "3"
+;
+""")
+    assert Points.from_minc_tag(tmp_path / 'one.tag', chunk_size=chunk_size) == expected
+    assert Points.from_minc_tag(tmp_path / 'two.tag', chunk_size=chunk_size) == expected
+    for bad in ['MNI Tag Point File\nVolumes = 1;\nPoints =\n 1 2 3 0 "1";\n',
+                'MNI Tag Point File\nVolumes = 1;\nPoints =\n 1 2 3 "1"\n',
+                'MNI Tag Point File\nVolumes = 1;\nPoints =\n 1 2 3 "1" 4 5 6;\n',
+                'MNI Tag Point File\nVolumes = 3;\nPoints =\n 1 2 3 "1";\n',
+                'Tag Point File\nVolumes = 1;\nPoints =\n 1 2 3 "1";\n']:
+        (tmp_path / 'bad.tag').write_text(bad)
+        with pytest.raises(RuntimeError):
+            Points.from_minc_tag(tmp_path / 'bad.tag', chunk_size=chunk_size)
+
+
+def test_mrk_json(tmp_path):
+    (tmp_path / 'lps.mrk.json').write_text(json.dumps({
+        'markups': [{'type': 'Fiducial', 'coordinateSystem': 'LPS',
+                     'controlPoints': [{'id': '1', 'label': '10', 'position': [-1.1, -1.2, 1.3]}]},
+                    {'type': 'Fiducial', 'coordinateSystem': 'RAS',
+                     'controlPoints': [{'id': '1', 'label': '20', 'position': [2.1, 2.2, 2.3]}]}]}))
+    assert Points.from_file(tmp_path / 'lps.mrk.json') == Points([SinglePoint(1.1, 1.2, 1.3, 10),
+                                                                 SinglePoint(2.1, 2.2, 2.3, 20)])
+    with pytest.raises(RuntimeError):
+        Points.from_file(tmp_path / 'points.xyz')
+
+
+def test_convert_batch(points_path):
+    infiles = [str(points_path / name) for name in ['ants.csv', 'mni.tag', 'simple.tsv', 'slicer.fcsv']]
+    subprocess.check_call(['convertpoints', '--batch'] + infiles +
+                          ['--output_dir', str(points_path / 'out'), '--output_ext', '.fcsv', '.mrk.json'])
+    for name in ['ants', 'mni', 'simple', 'slicer']:
+        assert cmp(points_path / 'out' / (name + '.fcsv'), points_path / 'slicer.fcsv')
+        assert Points.from_file(points_path / 'out' / (name + '.mrk.json')) == Points.from_file(infiles[0])
+
+
+def test_queries(tmp_path):
+    rng = np.random.RandomState(0)
+    ref = Points.from_arrays(rng.uniform(-100.0, 100.0, size=(500, 3)), rng.permutation(500))
+    test = Points.from_arrays(ref.coords[::-1] + rng.normal(scale=0.5, size=(500, 3)), ref.index[::-1])
+    alldist = np.sqrt(np.sum((test.coords[:, np.newaxis, :] - ref.coords[np.newaxis, :, :]) ** 2, axis=2))
+    dist, pos = ref.nearest(test)
+    assert np.allclose(dist, np.min(alldist, axis=1))
+    assert np.all(pos == np.argmin(alldist, axis=1))
+    assert ref.kdtree is ref.kdtree
+    for positions, row in zip(ref.within(test, 20.0), alldist):
+        assert sorted(positions) == list(np.flatnonzero(row <= 20.0))
+    partial = Points.from_arrays(test.coords[:400], test.index[:400])
+    index, dist, diff = ref.matched_distances(partial)
+    assert len(index) == 400
+    pos = np.array([list(ref.index).index(i) for i in index])
+    assert np.all(np.diff(pos) > 0)
+    ppos = np.array([list(partial.index).index(i) for i in index])
+    assert np.allclose(diff, partial.coords[ppos] - ref.coords[pos])
+    assert np.allclose(dist, alldist[ppos, pos])
+
+    ref.to_file(tmp_path / 'ref.tsv')
+    partial.to_file(tmp_path / 'partial.fcsv')
+    subprocess.check_call(['landmarkerrors', str(tmp_path / 'ref.tsv'), str(tmp_path / 'partial.fcsv'),
+                           str(tmp_path / 'ref.tsv'), '--output', str(tmp_path / 'errors.tsv')])
+    df = pd.read_csv(tmp_path / 'errors.tsv', sep='\t', keep_default_na=False, na_values=['n/a'])
+    assert list(df.columns) == ['file', 'index', 'distance', 'dx', 'dy', 'dz', 'nearest_index', 'nearest_distance']
+    assert len(df) == 1000
+    first = df[df['file'] == str(tmp_path / 'partial.fcsv')].set_index('index').loc[index]
+    assert np.allclose(first['distance'], dist)
+    assert df['distance'].isna().sum() == 100
+    second = df[df['file'] == str(tmp_path / 'ref.tsv')]
+    assert np.all(second['distance'] == 0.0)
+    assert np.all(second['nearest_index'] == second['index'])
+
+
+def test_convert_batch_failure(points_path, tmp_path):
+    bad = tmp_path / 'bad.tsv'
+    bad.write_text('not\ta\tpoints file\n')
+    infiles = [str(bad), str(points_path / 'simple.tsv')]
+    proc = subprocess.run(['convertpoints', '--batch'] + infiles + ['--output_dir', str(tmp_path / 'out'),
+                                                                     '--output_ext', '.fcsv'],
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.returncode == 1
+    assert 'bad.tsv' in proc.stderr
+    assert cmp(tmp_path / 'out' / 'simple.fcsv', points_path / 'slicer.fcsv')
+
+
+def test_convert_batch_collision(points_path, tmp_path):
+    other = tmp_path / 'other'
+    other.mkdir()
+    shutil.copy(str(points_path / 'simple.tsv'), str(other / 'simple.tsv'))
+    infiles = [str(points_path / 'simple.tsv'), str(other / 'simple.tsv')]
+    proc = subprocess.run(['convertpoints', '--batch'] + infiles + ['--output_dir', str(tmp_path / 'out'),
+                                                                     '--output_ext', '.fcsv'],
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.returncode == 2
+    assert 'simple.fcsv' in proc.stderr
+    assert not (tmp_path / 'out').exists()
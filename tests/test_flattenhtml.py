@@ -0,0 +1,158 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import pytest
+import subprocess
+from pndni.flattenhtml import write_base64, ImageCache
+
+
+HTML = """<!DOCTYPE html>
+<html>
+<!-- a comment -->
+<body><p class="x">Some text</p>
+<img src="{src1}" alt="first">
+<div><img width="10" src="{src2}"></div>
+<img src="{src1}"><img src="{src3}"><img src="{src4}"><img src="{src5}">
+</body>
+</html>
+"""
+
+
+@pytest.fixture
+def html_path(tmp_path):
+    (tmp_path / 'imgs').mkdir()
+    images = {'a.png': os.urandom(100000), 'imgs/b.png': os.urandom(1000), 'c.JPG': os.urandom(10),
+              'd.gif': os.urandom(20), 'e.svg': b'<svg xmlns="http://www.w3.org/2000/svg"></svg>'}
+    for name, data in images.items():
+        (tmp_path / name).write_bytes(data)
+    sources = [('src1', 'a.png', 'image/png'), ('src2', 'imgs/b.png', 'image/png'), ('src3', 'c.JPG', 'image/jpeg'),
+               ('src4', 'd.gif', 'image/gif'), ('src5', 'e.svg', 'image/svg+xml')]
+    (tmp_path / 'report.html').write_text(HTML.format(**{key: name for key, name, mtype in sources}))
+    expected = HTML.format(**{key: f'data:{mtype};base64,' + base64.b64encode(images[name]).decode()
+                              for key, name, mtype in sources})
+    # declarations are followed by a newline
+    expected = expected.replace('<!DOCTYPE html>\n', '<!DOCTYPE html>\n\n')
+    return tmp_path, expected
+
+
+@pytest.mark.parametrize('chunk_size', [3, 300, 3 * 2 ** 16])
+def test_write_base64(tmp_path, chunk_size):
+    data = os.urandom(1000)
+    (tmp_path / 'x.png').write_bytes(data)
+    out = io.StringIO()
+    write_base64(tmp_path / 'x.png', out, chunk_size=chunk_size)
+    assert out.getvalue() == base64.b64encode(data).decode()
+    with pytest.raises(ValueError):
+        write_base64(tmp_path / 'x.png', out, chunk_size=4)
+
+
+@pytest.mark.parametrize('threads', ['0', '1', '4'])
+def test_flattenhtml(html_path, threads):
+    tmp_path, expected = html_path
+    out = subprocess.run(['flattenhtml', str(tmp_path / 'report.html'), '--threads', threads],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    assert out == expected
+    subprocess.run(['flattenhtml', str(tmp_path / 'report.html'), '-o', str(tmp_path / 'flat.html'),
+                    '--threads', threads], check=True)
+    assert (tmp_path / 'flat.html').read_text() == expected
+    (tmp_path / 'bad.html').write_text('<img src="x.bmp">')
+    assert subprocess.run(['flattenhtml', str(tmp_path / 'bad.html'), '--threads', threads],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0
+    assert subprocess.run(['flattenhtml', str(tmp_path / 'bad.html'), '-o', str(tmp_path / 'bad_flat.html'),
+                           '--threads', threads], stderr=subprocess.DEVNULL).returncode != 0
+    assert not (tmp_path / 'bad_flat.html').exists()
+
+
+@pytest.mark.parametrize('threads', [0, 2])
+def test_image_cache(tmp_path, threads):
+    (tmp_path / 'sub').mkdir()
+    for name in 'abcd':
+        (tmp_path / (name + '.png')).write_bytes(name.encode() * 30)
+    uris = {name: 'data:image/png;base64,' + base64.b64encode(name.encode() * 30).decode() for name in 'abcd'}
+
+    def held():
+        return sorted(os.path.basename(key[0])[0] for key in cache._images)
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        # room for two images
+        cache = ImageCache(executor if threads else None, window=2, max_bytes=2 * len(uris['a']))
+        cache.plan([(tmp_path / (name + '.png'), 'image/png') for name in ['a', 'b', 'c', 'a', 'd']])
+        assert held() == (['a', 'b'] if threads else [])
+        uri = cache.get(tmp_path / 'a.png', 'image/png')
+        assert uri == uris['a']
+        for name in ['b', 'c']:
+            assert cache.get(tmp_path / (name + '.png'), 'image/png') == uris[name]
+        # a is needed again, so the least recently used other image (b) is dropped
+        assert 'a' in held() and 'b' not in held()
+        assert cache.get(tmp_path / 'sub' / '..' / 'a.png', 'image/png') is uri
+        assert cache.get(tmp_path / 'd.png', 'image/png') == uris['d']
+        assert held() == ['a', 'd']
+        # the cache is shared by the next html file, and picks up modified images
+        cache.plan([(tmp_path / 'd.png', 'image/png'), (tmp_path / 'a.png', 'image/png')])
+        assert cache.get(tmp_path / 'd.png', 'image/png') == uris['d']
+        (tmp_path / 'a.png').write_bytes(b'abcdef')
+        new_uri = 'data:image/png;base64,' + base64.b64encode(b'abcdef').decode()
+        assert cache.get(tmp_path / 'a.png', 'image/png') == new_uri
+
+
+def test_flattenhtml_batch(html_path):
+    tmp_path, expected = html_path
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'imgs').symlink_to(tmp_path / 'imgs')
+    for name in ['a.png', 'c.JPG', 'd.gif', 'e.svg']:
+        (tmp_path / 'sub' / name).write_bytes((tmp_path / name).read_bytes())
+    (tmp_path / 'sub' / 'report2.html').write_text((tmp_path / 'report.html').read_text())
+    (tmp_path / 'sub' / 'bad.html').write_text('<img src="missing.png">')
+    (tmp_path / 'other.html').write_text('<p>no images</p>')
+    for output_dir in [None, tmp_path / 'flat']:
+        cmd = ['flattenhtml', '--batch', str(tmp_path), '--nprocs', '2']
+        if output_dir is not None:
+            cmd += ['--output_dir', str(output_dir)]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        assert proc.returncode == 1
+        assert 'bad.html' in proc.stderr
+        outdir = tmp_path if output_dir is None else output_dir
+        assert (outdir / 'report_flat.html').read_text() == expected
+        assert (outdir / 'sub' / 'report2_flat.html').read_text() == expected
+        assert (outdir / 'other_flat.html').read_text() == '<p>no images</p>'
+        assert not (outdir / 'sub' / 'bad_flat.html').exists()
+        lines = [line.split('\t') for line in proc.stdout.splitlines()]
+        assert lines[0] == ['report', 'bytes_embedded', 'seconds']
+        assert len(lines) == 5
+        sizes = {row[0]: int(row[1]) for row in lines[1:-1]}
+        assert sizes[str(outdir / 'report_flat.html')] > 100000
+        assert sizes[str(outdir / 'report_flat.html')] == sizes[str(outdir / 'sub' / 'report2_flat.html')]
+        assert sizes[str(outdir / 'other_flat.html')] == 0
+        assert lines[-1][0] == 'total' and int(lines[-1][1]) == sum(sizes.values())
+    # outputs are not flattened again
+    proc = subprocess.run(['flattenhtml', '--batch', str(tmp_path)], stdout=subprocess.PIPE, universal_newlines=True)
+    assert len(proc.stdout.splitlines()) == 5
+
+
+def test_flattenhtml_batch_overwrite(html_path):
+    tmp_path, expected = html_path
+    html = (tmp_path / 'report.html').read_text()
+    for extra in [[], ['--output_dir', str(tmp_path)]]:
+        proc = subprocess.run(['flattenhtml', '--batch', str(tmp_path), '--suffix', ''] + extra,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        assert proc.returncode == 2
+        assert 'overwritten' in proc.stderr
+        assert (tmp_path / 'report.html').read_text() == html
+    subprocess.run(['flattenhtml', '--batch', str(tmp_path / 'report.html'), '--suffix', '',
+                    '--output_dir', str(tmp_path / 'flat')], check=True, stdout=subprocess.DEVNULL)
+    assert (tmp_path / 'flat' / 'report.html').read_text() == expected
+
+
+def test_flattenhtml_batch_collision(tmp_path):
+    for d in ['d1', 'd2']:
+        (tmp_path / d).mkdir()
+        (tmp_path / d / 'index.html').write_text('<p>no images</p>')
+    for args in [[str(tmp_path / 'd1'), str(tmp_path / 'd2'), '--output_dir', str(tmp_path / 'out')],
+                 [str(tmp_path / 'd1'), str(tmp_path / 'd1' / 'index.html')]]:
+        proc = subprocess.run(['flattenhtml', '--batch'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        assert proc.returncode == 2
+        assert 'index_flat.html' in proc.stderr
+    assert not (tmp_path / 'out').exists()
+    assert not (tmp_path / 'd1' / 'index_flat.html').exists()
@@ -2,6 +2,8 @@ from itertools import product
 import subprocess
 import nibabel
 import numpy as np
+import pytest
+from pndni.labels2probmaps import calc_probmaps, count_labels
 
 
 def _wrapper(tmpdir, labels, label_names, label_names_out, bids_labels=False):
@@ -61,3 +63,79 @@ def test_combinelabels5(tmpdir):
     outlist = _wrapper(tmpdir, [l1, l2, l3], [1, 3], [1, 3])
     assert np.all(outlist[0] == [1, 1/3, 2/3, 1/3, 1/3, 0])
     assert np.all(outlist[1] == [0, 0, 1/3, 0, 0, 2/3])
+
+
+def test_calc_probmaps(tmpdir):
+    rng = np.random.RandomState(0)
+    fnames = []
+    data = []
+    for i in range(4):
+        data.append(rng.randint(0, 6, size=(3, 4, 5)))
+        fnames.append(str(tmpdir / f'l{i}.nii'))
+        nibabel.Nifti1Image(data[-1], None).to_filename(fnames[-1])
+    for labels, nprocs in product([None, [5, 1, 3, 7]], [1, 3]):
+        probmaps = calc_probmaps(fnames, labels=labels, nprocs=nprocs)
+        truelabels = np.unique(data[0]) if labels is None else labels
+        assert list(probmaps.keys()) == list(truelabels)
+        for l in truelabels:
+            truth = np.mean([x == l for x in data], axis=0)
+            assert probmaps[l].dtype == np.double
+            assert np.allclose(probmaps[l], truth)
+    probmaps = calc_probmaps(fnames, labels=[2], dtype=np.float32)
+    assert probmaps[2].dtype == np.float32
+    assert np.allclose(probmaps[2], np.mean([x == 2 for x in data], axis=0))
+    outtemplate = str(tmpdir / 'out_{label}.nii')
+    subprocess.check_call(['labels2probmaps', outtemplate] + fnames + ['--float32', '--labels', '2', '--nprocs', '2'])
+    out = nibabel.load(outtemplate.format(label=2))
+    assert out.get_data_dtype() == np.float32
+    assert np.allclose(out.get_fdata(), probmaps[2])
+
+
+def test_single_file_checkpoint(tmpdir):
+    rng = np.random.RandomState(0)
+    fnames = []
+    data = []
+    for i in range(5):
+        data.append(rng.randint(0, 4, size=(3, 4, 5)))
+        fnames.append(str(tmpdir / f'l{i}.nii'))
+        nibabel.Nifti1Image(data[-1], None).to_filename(fnames[-1])
+    checkpoint = str(tmpdir / 'checkpoint.npz')
+    # an interrupted run that processed the first three files
+    count_labels(fnames[:3], labels=[1, 3], checkpoint=checkpoint, checkpoint_every=2)
+    with pytest.raises(RuntimeError):
+        count_labels(fnames[1:], labels=[1, 3], checkpoint=checkpoint)
+    with pytest.raises(RuntimeError):
+        count_labels(fnames, labels=[1, 2], checkpoint=checkpoint)
+    # resuming must not count the files already counted
+    nibabel.Nifti1Image(np.ones_like(data[0]), None).to_filename(fnames[0])
+    outfile = str(tmpdir / 'out.nii.gz')
+    subprocess.check_call(['labels2probmaps', outfile] + fnames + ['--labels', '1', '3', '--single_file',
+                                                                   '--checkpoint', checkpoint, '--checkpoint_every', '1'])
+    out = nibabel.load(outfile)
+    assert out.shape == (3, 4, 5, 2)
+    for i, l in enumerate([1, 3]):
+        assert np.allclose(out.get_fdata()[..., i], np.mean([x == l for x in data], axis=0))
+    with open(tmpdir / 'out.tsv', 'r') as f:
+        assert f.read() == 'index\tlabel\n0\t1\n1\t3\n'
+
+
+def test_checkpoint_more_files(tmpdir):
+    fnames = []
+    for i in range(300):
+        fnames.append(str(tmpdir / f'l{i}.nii'))
+        nibabel.Nifti1Image(np.ones((2, 2, 2), dtype=np.uint8), None).to_filename(fnames[-1])
+    checkpoint = str(tmpdir / 'checkpoint.npz')
+    labels, counts = count_labels(fnames[:200], labels=[1], checkpoint=checkpoint, checkpoint_every=200)
+    assert counts.dtype == np.uint8
+    labels, counts = count_labels(fnames, labels=[1], checkpoint=checkpoint, checkpoint_every=200)
+    assert np.all(counts == 300)
+
+
+@pytest.mark.parametrize('nprocs,checkpoint_every', [(1, 100), (2, 100), (1, 1)])
+def test_shape_mismatch(tmpdir, nprocs, checkpoint_every):
+    fnames = [str(tmpdir / 'l0.nii'), str(tmpdir / 'l1.nii')]
+    nibabel.Nifti1Image(np.ones((4, 4, 4), dtype=np.uint8), None).to_filename(fnames[0])
+    nibabel.Nifti1Image(np.ones((4, 4, 2), dtype=np.uint8), None).to_filename(fnames[1])
+    with pytest.raises(ValueError, match='shape'):
+        count_labels(fnames, nprocs=nprocs, checkpoint=str(tmpdir / 'checkpoint.npz'),
+                     checkpoint_every=checkpoint_every)
@@ -0,0 +1,127 @@
+import h5py
+import nibabel
+import numpy as np
+import pytest
+import subprocess
+from pndni.mnclabel2niilabel import minc2labels
+
+
+DATA = (np.arange(4 * 5 * 6) % 7).reshape((4, 5, 6)).astype(np.float64)
+AFFINE = np.array([[1.0, 0.0, 0.0, -5.0],
+                   [0.0, 2.0, 0.0, 3.0],
+                   [0.0, 0.0, 3.0, 0.0],
+                   [0.0, 0.0, 0.0, 1.0]])
+
+
+def _label_minc2(fname, data, scaled):
+    with h5py.File(fname, 'w') as f:
+        root = f.create_group('minc-2.0')
+        dim = root.create_group('dimensions')
+        for d, length, step, start in zip(['xspace', 'yspace', 'zspace'], data.shape[::-1],
+                                          np.diag(AFFINE)[:3], AFFINE[:3, 3]):
+            grp = dim.create_dataset(d, data=np.array(0, np.int32))
+            grp.attrs['spacing'] = np.bytes_(b'regular__')
+            grp.attrs['step'] = step
+            grp.attrs['start'] = start
+            grp.attrs['length'] = length
+        if scaled:
+            # stored as uint16, with a different real range for each slice
+            imax = np.max(data.reshape(data.shape[0], -1), axis=1)
+            stored = np.around(data / imax[:, np.newaxis, np.newaxis] * 65535).astype(np.uint16)
+            img = root.create_dataset('image/0/image', data=stored)
+            img.attrs['valid_range'] = np.array([0.0, 65535.0])
+            imgmin = root.create_dataset('image/0/image-min', data=np.zeros(data.shape[0]))
+            imgmax = root.create_dataset('image/0/image-max', data=imax)
+            imgmin.attrs['dimorder'] = np.bytes_(b'zspace')
+            imgmax.attrs['dimorder'] = np.bytes_(b'zspace')
+        else:
+            img = root.create_dataset('image/0/image', data=data)
+            img.attrs['valid_range'] = np.array([np.min(data), np.max(data)])
+            root.create_dataset('image/0/image-min', data=np.min(data))
+            root.create_dataset('image/0/image-max', data=np.max(data))
+        img.attrs['dimorder'] = np.bytes_(b'zspace,yspace,xspace')
+
+
+@pytest.mark.parametrize('scaled', [False, True])
+@pytest.mark.parametrize('chunk_size', [1, 10 ** 6])
+def test_minc2labels(tmp_path, scaled, chunk_size):
+    fname = str(tmp_path / 'labels.mnc')
+    _label_minc2(fname, DATA, scaled)
+    out = minc2labels(fname, chunk_size=chunk_size)
+    assert out.get_data_dtype() == np.uint8
+    assert out.shape == (6, 5, 4)
+    assert np.all(np.asarray(out.dataobj) == DATA.transpose())
+    assert np.allclose(out.affine, AFFINE)
+
+
+def test_minc2labels_errors(tmp_path):
+    fname = str(tmp_path / 'labels.mnc')
+    _label_minc2(fname, DATA + 0.2, False)
+    with pytest.raises(ValueError):
+        minc2labels(fname)
+    assert minc2labels(fname, tol=0.25).shape == (6, 5, 4)
+    _label_minc2(fname, DATA - 1, False)
+    with pytest.raises(ValueError):
+        minc2labels(fname)
+
+
+def test_mnclabel2niilabel(tmp_path):
+    fname = str(tmp_path / 'labels.mnc')
+    outname = str(tmp_path / 'labels.nii.gz')
+    _label_minc2(fname, DATA, True)
+    subprocess.run(['mnclabel2niilabel', fname, outname], check=True)
+    out = nibabel.load(outname)
+    assert np.all(np.asarray(out.dataobj) == DATA.transpose())
+    assert np.allclose(out.affine, AFFINE)
+    _label_minc2(fname, DATA + 0.2, False)
+    proc = subprocess.run(['mnclabel2niilabel', fname, outname], stdout=subprocess.PIPE, universal_newlines=True)
+    assert proc.returncode == 1
+    assert 'not close enough to integers' in proc.stdout
+
+
+def test_mnclabel2niilabel_batch(tmp_path):
+    indir = tmp_path / 'minc'
+    indir.mkdir()
+    _label_minc2(str(indir / 'a.mnc'), DATA, False)
+    _label_minc2(str(indir / 'b.mnc'), DATA + 1, True)
+    _label_minc2(str(indir / 'bad.mnc'), DATA + 0.2, False)
+    _label_minc2(str(tmp_path / 'c.mnc'), DATA + 2, False)
+    outdir = tmp_path / 'nifti'
+    cmd = ['mnclabel2niilabel', '--inputs', str(indir), str(tmp_path / 'c.mnc'), '--output_dir', str(outdir),
+           '--nprocs', '2']
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.returncode == 1
+    assert 'bad.mnc' in proc.stderr and 'not close enough to integers' in proc.stderr
+    assert '3 converted, 0 skipped, 1 failed' in proc.stdout
+    for name, offset in [('a', 0), ('b', 1), ('c', 2)]:
+        out = nibabel.load(str(outdir / (name + '.nii.gz')))
+        assert np.all(np.asarray(out.dataobj) == DATA.transpose() + offset)
+    assert not (outdir / 'bad.nii.gz').exists()
+    proc = subprocess.run(cmd[:-2] + ['--ext', '.nii'], stdout=subprocess.PIPE, universal_newlines=True)
+    assert '3 converted, 0 skipped, 1 failed' in proc.stdout
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    assert '0 converted, 3 skipped, 1 failed' in proc.stdout
+
+
+def test_minc2labels_widen(tmp_path):
+    # a later slab needs a wider type than the first
+    fname = str(tmp_path / 'labels.mnc')
+    data = DATA.copy()
+    data[3, 0, 0] = 1000
+    _label_minc2(fname, data, False)
+    out = minc2labels(fname, chunk_size=30)
+    assert out.get_data_dtype() == np.uint16
+    assert np.all(np.asarray(out.dataobj) == data.transpose())
+
+
+def test_mnclabel2niilabel_batch_collision(tmp_path):
+    for d in ['a', 'b']:
+        (tmp_path / d).mkdir()
+        _label_minc2(str(tmp_path / d / 'x.mnc'), DATA, False)
+    outdir = tmp_path / 'nifti'
+    proc = subprocess.run(['mnclabel2niilabel', '--inputs', str(tmp_path / 'a'), str(tmp_path / 'b'),
+                           '--output_dir', str(outdir)], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    assert proc.returncode == 2
+    assert 'x.nii.gz' in proc.stderr
+    assert not outdir.exists()
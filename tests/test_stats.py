@@ -1,7 +1,12 @@
 import numpy as np
+import pandas as pd
 import nibabel
+import pickle
 import subprocess
-from pndni.stats import stats, std
+from functools import partial
+from scipy.ndimage import labeled_comprehension
+from scipy.stats import skew, kurtosis
+from pndni.stats import stats, std, get_parser, LabelGroups, _GROUPED
 
 
 def wrap(basecmd, inputfile, statslist, maskfile=None):
@@ -44,3 +49,127 @@ def test(tmp_path):
             py = stats(inputfile, [statsmap[stat] for stat in statslist], K=m)
             assert np.allclose(truth, py)
             assert np.allclose(truth, cmd)
+
+
+def test_grouped(tmp_path):
+    inputfile = str(tmp_path / 'in.nii')
+    maskfile = str(tmp_path / 'mask.nii')
+    rng = np.random.RandomState(0)
+    input = rng.normal(size=(6, 7, 8))
+    mask = rng.randint(0, 6, size=input.shape)
+    mask[mask == 3] = 0  # missing label
+    mask[mask == 5] = 0
+    mask[0, 0, 0] = 5  # single voxel label
+    mask[mask == 4] = 0
+    mask[1, 1, :2] = 4  # constant label
+    input[1, 1, :2] = 2.0
+    nibabel.Nifti1Image(input, np.eye(4)).to_filename(inputfile)
+    nibabel.Nifti1Image(mask, np.eye(4)).to_filename(maskfile)
+    args = get_parser().parse_args(['-K', maskfile, inputfile, '-m', '-s', '--skew', '--kurtosis', '--median'])
+    py = stats(args.input, args.statslist, K=args.K)
+    truth = []
+    for l in range(1, 6):
+        truth.extend([labeled_comprehension(input, mask, l, func, np.float, 0.0) for func in args.statslist])
+    assert len(py) == len(truth) == 25
+    assert np.allclose(py, truth, equal_nan=True)
+    unknown = partial(np.percentile, q=25)
+    py = stats(inputfile, [unknown, np.mean], K=maskfile)
+    truth = []
+    for l in range(1, 6):
+        truth.extend([labeled_comprehension(input, mask, l, func, np.float, 0.0) for func in [unknown, np.mean]])
+    assert np.allclose(py, truth)
+
+
+def test_grouped_nan(tmp_path):
+    inputfile = str(tmp_path / 'in.nii')
+    maskfile = str(tmp_path / 'mask.nii')
+    rng = np.random.RandomState(0)
+    input = rng.normal(size=(6, 7, 8))
+    mask = rng.randint(1, 4, size=input.shape)
+    input[0, 0, 0] = np.nan
+    mask[0, 0, 0] = 2
+    mask[1, 1, 1] = 3
+    input[1, 1, 1] = np.nan
+    mask[mask == 3] = 0
+    mask[1, 1, 1] = 3  # single nan voxel
+    nibabel.Nifti1Image(input, np.eye(4)).to_filename(inputfile)
+    nibabel.Nifti1Image(mask, np.eye(4)).to_filename(maskfile)
+    args = get_parser().parse_args(['-K', maskfile, inputfile, '-m', '-s', '--skew', '--kurtosis', '--median'])
+    py = np.array(stats(args.input, args.statslist, K=args.K)).reshape(3, 5)
+    truth = np.array([[labeled_comprehension(input, mask, l, func, np.float, 0.0) for func in args.statslist]
+                      for l in range(1, 4)])
+    assert np.allclose(py, truth, equal_nan=True)
+    assert np.all(np.isfinite(py[0]))
+    label2 = input[mask == 2]
+    assert np.all(np.isnan(py[1])) and np.isnan(np.median(label2)) and np.isnan(skew(label2))
+    assert np.isnan(kurtosis(label2))
+    # std of a single voxel is 0.0, even if it is nan
+    assert np.isnan(py[2, [0, 2, 3, 4]]).all() and py[2, 1] == 0.0
+
+
+
+def test_grouped_constant():
+    # constant labels whose bincount mean is inexact
+    rng = np.random.RandomState(0)
+    input = rng.normal(size=(10, 10, 30))
+    mask = np.ones(input.shape, dtype=int)
+    for label, value in [(2, 0.3), (3, 0.1), (4, 1e5 + 0.1)]:
+        mask[label] = label
+        input[label] = value
+    args = get_parser().parse_args(['x.nii', '--skew', '--kurtosis'])
+    for func in args.statslist:
+        truth = labeled_comprehension(input, mask, [1, 2, 3, 4], func, np.float, 0.0)
+        out = _GROUPED[func](LabelGroups(input, mask, 4))
+        assert np.allclose(out[0], truth[0])
+        np.testing.assert_array_equal(out[1:], truth[1:])
+
+
+def test_batch(tmp_path):
+    rng = np.random.RandomState(0)
+    mask = np.zeros((3, 4, 5), dtype=np.int16)
+    mask[:2] = 1
+    mask[2, :2] = 2
+    maskfile = str(tmp_path / 'mask.nii')
+    nibabel.Nifti1Image(mask, np.eye(4)).to_filename(maskfile)
+    inputfiles = []
+    for i in range(3):
+        inputfiles.append(str(tmp_path / f'sub-{i}.nii.gz'))
+        nibabel.Nifti1Image(rng.normal(size=mask.shape), np.eye(4)).to_filename(inputfiles[-1])
+    with open(tmp_path / 'manifest.tsv', 'w') as f:
+        f.write('subject\tinput\tmask\n')
+        for i, inputfile in enumerate(inputfiles):
+            f.write(f'{i}\t{inputfile}\t{maskfile if i > 0 else ""}\n')
+    outfile = str(tmp_path / 'out.tsv')
+    subprocess.check_call(['stats', '--manifest', str(tmp_path / 'manifest.tsv'), '--output', outfile, '-m', '--median'])
+    out = pd.read_csv(outfile, sep='\t', dtype={'subject': str, 'label': str}, keep_default_na=False)
+    assert list(out.columns) == ['subject', 'label', 'mean', 'median']
+    assert list(out['subject']) == ['0', '1', '1', '2', '2']
+    assert list(out['label']) == ['n/a', '1', '2', '1', '2']
+    assert np.allclose(out.iloc[0, 2:].astype(float), stats(inputfiles[0], [np.mean, np.median]))
+    for i in [1, 2]:
+        truth = stats(inputfiles[i], [np.mean, np.median], K=maskfile)
+        assert np.allclose(out[out['subject'] == str(i)].iloc[:, 2:].values.astype(float).ravel(), truth)
+    outfile2 = str(tmp_path / 'out2.tsv')
+    subprocess.check_call(['stats', '--glob', str(tmp_path / 'sub-*.nii.gz'), '-K', maskfile,
+                           '--output', outfile2, '-m', '--median', '--nprocs', '2'])
+    out2 = pd.read_csv(outfile2, sep='\t', dtype={'subject': str})
+    assert list(out2['subject']) == ['sub-0', 'sub-0', 'sub-1', 'sub-1', 'sub-2', 'sub-2']
+    assert np.allclose(out2.iloc[2:, 2:].astype(float), out.iloc[1:, 2:].astype(float))
+
+
+def test_batch_grouped(tmp_path):
+    # the statistics are pickled for the worker processes, and must still use the vectorized versions
+    args = get_parser().parse_args(['x.nii', '-m', '-s', '--skew', '--kurtosis', '--median'])
+    for func in args.statslist:
+        assert pickle.loads(pickle.dumps(func)) in _GROUPED
+    rng = np.random.RandomState(0)
+    mask = rng.randint(0, 3, size=(6, 7, 8))
+    maskfile = str(tmp_path / 'mask.nii')
+    nibabel.Nifti1Image(mask, np.eye(4)).to_filename(maskfile)
+    inputfile = str(tmp_path / 'sub-0.nii')
+    nibabel.Nifti1Image(rng.normal(size=mask.shape), np.eye(4)).to_filename(inputfile)
+    outfile = str(tmp_path / 'out.tsv')
+    subprocess.check_call(['stats', '--glob', str(tmp_path / 'sub-*.nii'), '-K', maskfile, '--output', outfile,
+                           '--skew', '--kurtosis', '--nprocs', '2'])
+    out = pd.read_csv(outfile, sep='\t', float_precision='round_trip')
+    assert list(out[['skew', 'kurtosis']].values.ravel()) == stats(inputfile, args.statslist[2:4], K=maskfile)
@@ -1,6 +1,7 @@
 import subprocess
 import nibabel
 import numpy as np
+from pndni.swaplabels import remap, Remapper, swap_files
 
 
 def wrapper(x, mapping, tmpdir):
@@ -28,3 +29,65 @@ def test_swaplabels2(tmpdir):
     out = wrapper(x, m, tmpdir)
     assert np.all(out == truth)
     assert out.dtype == np.uint16
+
+
+def test_remap():
+    rng = np.random.RandomState(0)
+    m = {1: 2, 2: 500, 7: 3, 10 ** 6: 4, -3: 5}
+    for x in [rng.randint(0, 10, size=(3, 4, 5)).astype(np.uint8),
+              rng.randint(-5, 10, size=(3, 4, 5)),
+              np.array([0, 1, 10 ** 6, 2, 7, 8]),
+              rng.randint(0, 10, size=(3, 4, 5)).astype(np.float32),
+              np.zeros((0, 3), dtype=np.int16)]:
+        truth = np.zeros(x.shape, np.uint16)
+        for key, val in m.items():
+            truth[x == key] = val
+        out = remap(x, m)
+        assert out.dtype == np.uint16
+        assert np.all(out == truth)
+    out = remap(np.array([0, 1, 2, 3, 300]), m, keep_unmapped=True)
+    assert np.all(out == [0, 2, 500, 3, 300])
+    assert out.dtype == np.uint16
+    out = remap(np.array([-1, 1, 2, 3, 300]), m, keep_unmapped=True)
+    assert np.all(out == [-1, 2, 500, 3, 300])
+    out = remap(np.array([0.5, 1, 2]), m, keep_unmapped=True)
+    assert np.all(out == [0.5, 2, 500])
+
+
+def test_swaplabels_files(tmpdir):
+    with open(tmpdir / 'map.tsv', 'w') as f:
+        f.write('in\tout\n1\t2\n2\t500\n')
+    with open(tmpdir / 'map.json', 'w') as f:
+        f.write('{"1": 2, "2": 500}')
+    x = np.array([0, 1, 2, 3, 4], dtype=np.uint8)
+    inputs = []
+    for i in range(3):
+        inputs.append(str(tmpdir / f'in{i}.nii.gz'))
+        nibabel.Nifti1Image(np.atleast_3d(x + i), None).to_filename(inputs[-1])
+    subprocess.check_call(['swaplabels', '--map_file', str(tmpdir / 'map.tsv'), inputs[0], str(tmpdir / 'out.nii')])
+    out = np.asarray(nibabel.load(str(tmpdir / 'out.nii')).dataobj).ravel()
+    assert np.all(out == [0, 2, 500, 0, 0])
+    subprocess.check_call(['swaplabels', '--map_file', str(tmpdir / 'map.json'), '--images'] + inputs +
+                          ['--nprocs', '2', '--keep_unmapped'])
+    for i in range(3):
+        out = np.asarray(nibabel.load(str(tmpdir / f'in{i}_swapped.nii.gz')).dataobj).ravel()
+        truth = remap(x + i, {1: 2, 2: 500}, keep_unmapped=True)
+        assert np.all(out == truth)
+    subprocess.check_call(['swaplabels', '1: 3', '--images', inputs[0], '--suffix', '_1to3'])
+    out = np.asarray(nibabel.load(str(tmpdir / 'in0_1to3.nii.gz')).dataobj).ravel()
+    assert np.all(out == [0, 3, 0, 0, 0])
+
+
+def test_swap_files_reuses_lut(tmpdir):
+    inputs = []
+    for i in range(3):
+        inputs.append(str(tmpdir / f'in{i}.nii'))
+        nibabel.Nifti1Image(np.atleast_3d(np.array([0, 1, 2, 3], dtype=np.uint8)), None).to_filename(inputs[-1])
+    outputs = [str(tmpdir / f'out{i}.nii') for i in range(3)]
+    remapper = Remapper({1: 2, 2: 500})
+    swap_files(inputs[:1], outputs[:1], remapper)
+    lut = remapper._luts[np.dtype(np.uint16)]
+    swap_files(inputs[1:], outputs[1:], remapper)
+    assert remapper._luts[np.dtype(np.uint16)] is lut
+    for output in outputs:
+        assert np.all(np.asarray(nibabel.load(output).dataobj).ravel() == [0, 2, 500, 0])
@@ -0,0 +1,104 @@
+import gzip
+import nibabel
+import numpy as np
+import pytest
+import shutil
+from pndni.utils import safeint, safeintload, slabs, save_image, store_slab, split_ext, try_call, duplicates
+
+
+def test_slabs():
+    for shape in [(3, 4, 5), (3, 4, 5, 2), (7,), (2, 0, 3)]:
+        x = np.arange(int(np.prod(shape))).reshape(shape)
+        for chunk_size in [1, 12, 13, 10 ** 6]:
+            out = np.zeros_like(x)
+            for sl in slabs(shape, chunk_size):
+                assert out[sl].size <= max(chunk_size, int(np.prod(shape)) // max(1, shape[min(2, len(shape) - 1)]))
+                out[sl] += x[sl] + 1
+            assert np.all(out == x + 1)
+
+
+def test_safeint():
+    x = np.array([0, 1, 300])
+    assert safeint(x.astype(np.uint16)).dtype == np.uint16
+    assert safeint(x.astype(np.int16)).dtype == np.uint16
+    assert np.all(safeint(x.astype(np.int16)) == x)
+    assert safeint(x.astype(np.float64)).dtype == np.uint16
+    assert safeint(np.array([0.0, 2.0])).dtype == np.uint8
+    for bad in [np.array([-1, 2]), np.array([0.5, 2.0]), np.array([-1.0, 2.0]), np.array([np.nan, 2.0]),
+                np.array([np.inf, 2.0])]:
+        with pytest.raises(ValueError):
+            safeint(bad)
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('chunk_size', [1, 10 ** 6])
+def test_safeintload(tmp_path, ext, chunk_size):
+    x = np.arange(3 * 4 * 5).reshape(3, 4, 5)
+    fname = str(tmp_path / ('x' + ext))
+    for dtype, outdtype in [(np.uint8, np.uint8), (np.int16, np.uint16), (np.float32, np.uint8), (np.float64, np.uint8)]:
+        nibabel.Nifti1Image(x.astype(dtype), np.eye(4)).to_filename(fname)
+        out = safeintload(fname, chunk_size=chunk_size)
+        assert out.dtype == outdtype
+        assert np.all(out == x)
+        if ext == '.nii' and dtype in [np.uint8, np.int16]:
+            assert isinstance(out, np.memmap)
+    # scaled data
+    img = nibabel.Nifti1Image(x.astype(np.int16), np.eye(4))
+    img.header.set_slope_inter(2.0, 1.0)
+    img.to_filename(fname)
+    out = safeintload(fname, chunk_size=chunk_size)
+    assert out.dtype == np.uint8
+    assert np.all(out == x * 2 + 1)
+    img.header.set_slope_inter(0.5, 0.0)
+    img.to_filename(fname)
+    with pytest.raises(ValueError):
+        safeintload(fname, chunk_size=chunk_size)
+    nibabel.Nifti1Image(x.astype(np.int16) - 1, np.eye(4)).to_filename(fname)
+    with pytest.raises(ValueError):
+        safeintload(fname, chunk_size=chunk_size)
+
+
+@pytest.mark.parametrize('threads', [1, pytest.param(4, marks=pytest.mark.skipif(shutil.which('pigz') is None,
+                                                                                  reason='pigz not installed'))])
+def test_save_image(tmp_path, threads):
+    x = np.arange(4000, dtype=np.int16).reshape(10, 20, 20) % 7
+    img = nibabel.Nifti1Image(x, np.diag([2.0, 2.0, 2.0, 1.0]))
+    sizes = {}
+    for compresslevel in [None, 0, 9]:
+        filename = tmp_path / f'out{compresslevel}.nii.gz'
+        save_image(img, filename, compresslevel=compresslevel, threads=threads)
+        with gzip.open(filename, 'rb') as f:
+            f.read()
+        out = nibabel.load(str(filename))
+        assert np.all(np.asarray(out.dataobj) == x)
+        assert np.all(out.affine == img.affine)
+        sizes[compresslevel] = filename.stat().st_size
+    assert sizes[0] > sizes[9]
+    save_image(img, tmp_path / 'out.nii', compresslevel=9, threads=threads)
+    out = nibabel.load(str(tmp_path / 'out.nii'))
+    assert np.all(np.asarray(out.dataobj) == x)
+
+
+def test_store_slab():
+    out = None
+    parts = [np.array([1, 2], np.uint8), np.array([300, 4], np.uint16), np.array([5, 6], np.uint8)]
+    for i, part in enumerate(parts):
+        out = store_slab(out, (3, 2), i, part)
+    assert out.dtype == np.uint16
+    assert np.all(out == [[1, 2], [300, 4], [5, 6]])
+
+
+def test_split_ext():
+    assert split_ext('a/b.nii.gz', ['.nii', '.gz', '.nii.gz']) == ('a/b', '.nii.gz')
+    assert split_ext('b.mnc', ['.nii']) == ('b.mnc', '')
+
+
+def test_try_call():
+    assert try_call(int, '3') == (3, None)
+    assert try_call(int, 'x') == (None, "ValueError: invalid literal for int() with base 10: 'x'")
+
+
+def test_duplicates(tmp_path):
+    names = [str(tmp_path / 'a'), str(tmp_path / 'b'), str(tmp_path / 'sub' / '..' / 'a')]
+    assert duplicates(names) == [names[0], names[2]]
+    assert duplicates(names[:2]) == []